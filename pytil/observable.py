@@ -18,20 +18,197 @@
 '''
 Observable collections
 
-Potential future addition
-http://code.activestate.com/recipes/306864-list-and-dictionary-observer/
+Each collection calls its change listeners with a delta of what changed after
+each mutating operation that actually changed it. When a listener raises, the
+change is rolled back without further notification.
 '''
 
-from contextlib import contextmanager
+from collections import deque, Counter
+from contextlib import contextmanager, suppress
+from functools import partial
+from array import array
+import threading
+import inspect
+import weakref
+import logging
+import asyncio
+import struct
+import pickle
+import mmap
+import os
 
 
-class Set(set):
+_logger = logging.getLogger(__name__)
+
+#: Marks a missing key/value
+_missing = object()
+
+def _equals(value1, value2):
+    '''
+    Get whether values are equal, for suppressing notifications of no-op
+    changes.
+
+    Values whose ``==`` raises or does not return a bool, e.g. numpy arrays,
+    are considered equal only if identical.
+    '''
+    if value1 is value2:
+        return True
+    try:
+        equals = value1 == value2
+    except Exception:
+        return False
+    return equals if isinstance(equals, bool) else False
+
+def _roll_back(listeners, **delta):
+    '''
+    Let listeners which accepted a change undo what they did with it, latest
+    first, as the change is being rolled back.
+
+    Listeners with a ``rollback`` attribute have it called with the delta.
+    '''
+    for listener in reversed(listeners):
+        rollback = getattr(listener, 'rollback', None)
+        if rollback is not None:
+            rollback(**delta)
+
+#: Header of a `Journal` file record: sequence number, payload length
+_journal_header = struct.Struct('<QQ')
+
+
+class _Observable:
+
+    'Base class of observable collections'
+
+    def subscribe(self, listener, priority=0, weak=False, on_error='raise'):
+        '''
+        Add a change listener with extra options.
+
+        Parameters
+        ----------
+        listener : ~typing.Callable
+            Change listener, see ``change_listeners``.
+        priority : int
+            Listeners with a higher priority are called first. Listeners with
+            equal priority are called in the order they were added. Listeners
+            appended to ``change_listeners`` directly have priority 0, so they
+            are called before listeners subscribed with a negative priority.
+        weak : bool
+            If True, only keep a weak reference to ``listener``. It is
+            unsubscribed as soon as it is garbage collected. When ``listener``
+            is a bound method, the reference is to its object.
+        on_error : str
+            What to do when the listener raises, one of:
+
+            raise
+                Roll back the change and raise, as with any change listener.
+            log
+                Log the exception and carry on as if the listener succeeded.
+
+        Returns
+        -------
+        Subscription
+            Handle to unsubscribe with. It is also a context manager which
+            unsubscribes on exit.
+        '''
+        subscription = Subscription(self._change_listeners, listener, priority, weak, on_error)
+        self._change_listeners.append(subscription)
+        return subscription
+
+class _ChangeListeners(list):
+
+    '''
+    List of change listeners which keeps them in order of priority.
+
+    Appended listeners are inserted after the last listener of at least their
+    priority: that of a `Subscription`, else 0. Listeners inserted at an
+    explicit index stay there.
+    '''
+
+    def append(self, listener):
+        priority = _priority(listener)
+        i = len(self)
+        while i and _priority(self[i - 1]) < priority:
+            i -= 1
+        self.insert(i, listener)
+
+    def extend(self, listeners):
+        for listener in listeners:
+            self.append(listener)
+
+    def __iadd__(self, listeners):
+        self.extend(listeners)
+        return self
+
+def _priority(listener):
+    return listener.priority if isinstance(listener, Subscription) else 0
+
+class Subscription:
+
+    '''
+    Change listener added by ``subscribe``.
+
+    Calling it calls the subscribed listener.
+    '''
+
+    def __init__(self, listeners, listener, priority, weak, on_error):
+        if on_error not in ('raise', 'log'):
+            raise ValueError(f'Invalid on_error: {on_error!r}')
+        self._listeners = listeners
+        self._on_error = on_error
+        self.priority = priority
+        if not weak:
+            self._listener = lambda: listener
+        elif inspect.ismethod(listener):
+            self._listener = weakref.WeakMethod(listener, self._on_collected)
+        else:
+            self._listener = weakref.ref(listener, self._on_collected)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unsubscribe()
+
+    def __call__(self, **delta):
+        listener = self._listener()
+        if listener is None:
+            return
+        if self._on_error == 'raise':
+            listener(**delta)
+        else:
+            try:
+                listener(**delta)
+            except Exception:
+                _logger.exception('Change listener raised, ignoring')
+
+    def rollback(self, **delta):
+        'Call the ``rollback`` of the subscribed listener, if any'
+        rollback = getattr(self._listener(), 'rollback', None)
+        if rollback is None:
+            return
+        if self._on_error == 'raise':
+            rollback(**delta)
+        else:
+            try:
+                rollback(**delta)
+            except Exception:
+                _logger.exception('Change listener rollback raised, ignoring')
+
+    def _on_collected(self, _):
+        self.unsubscribe()
+
+    def unsubscribe(self):
+        'Remove the listener, if not already removed'
+        with suppress(ValueError):
+            self._listeners.remove(self)
+
+class Set(_Observable, set):
 
     'Observable set'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._change_listeners = []
+        self._change_listeners = _ChangeListeners()
         self._watching = False
 
     @property
@@ -49,7 +226,9 @@ class Set(set):
             the items that were added, and the items that were removed. Note:
             Items can be added and removed from a set in a single operation.
             When a listener raises, the change is rolled back without further
-            notification.
+            notification. Listeners which were already called are told through
+            their ``rollback`` attribute, if any, which is called with the same
+            arguments.
         '''
         return self._change_listeners
 
@@ -63,21 +242,58 @@ class Set(set):
                 self._watching = True
                 original = self.copy()
                 yield
-                added = self - original
-                removed = original - self
-                if added or removed:
-                    added = frozenset(added)
-                    removed = frozenset(removed)
-                    for listener in self._change_listeners:
-                        try:
-                            listener(added=added, removed=removed)
-                        except Exception as ex:
-                            self -= added
-                            self |= removed
-                            raise ex
+                self._notify(frozenset(self - original), frozenset(original - self))
             finally:
                 self._watching = False
 
+    def _notify(self, added, removed):
+        if added or removed:
+            called = []
+            for listener in tuple(self._change_listeners):
+                try:
+                    listener(added=added, removed=removed)
+                except Exception as ex:
+                    set.difference_update(self, added)
+                    set.update(self, removed)
+                    _roll_back(called, added=added, removed=removed)
+                    raise ex
+                called.append(listener)
+
+    def _undo(self, added, removed):
+        '''
+        Undo a change which the listeners accepted, without notifying them
+        other than through their ``rollback``.
+
+        Parameters
+        ----------
+        added : ~typing.FrozenSet
+            Items the change added.
+        removed : ~typing.FrozenSet
+            Items the change removed.
+        '''
+        if added or removed:
+            set.difference_update(self, added)
+            set.update(self, removed)
+            _roll_back(self._change_listeners, added=added, removed=removed)
+
+    def _apply_delta(self, added, removed):
+        '''
+        Apply change and notify.
+
+        Unlike the public mutators, this does not copy the set to find out what
+        changed, so it only takes O(len(added) + len(removed)).
+
+        Parameters
+        ----------
+        added : ~typing.FrozenSet
+            Items to add, none of which may be in the set already.
+        removed : ~typing.FrozenSet
+            Items to remove, all of which must be in the set.
+        '''
+        set.difference_update(self, removed)
+        set.update(self, added)
+        self._notify(added, removed)
+
     def add(self, item):
         with self._notify_if_changed():
             super().add(item)
@@ -129,3 +345,822 @@ class Set(set):
     def clear(self):
         with self._notify_if_changed():
             super().clear()
+
+class ThreadSafeSet(Set):
+
+    '''
+    Observable set which may be changed from multiple threads.
+
+    A lock is held while changing the set and working out what changed, but
+    not while calling listeners, so a slow listener does not block other
+    threads from changing the set. Listeners are called for each change in
+    the order the changes were made, one change at a time: a thread which
+    changed the set calls the listeners for its change and for any changes
+    other threads made meanwhile; the other threads return right away.
+
+    Unlike with `Set`, listeners cannot roll back changes as other threads may
+    already have changed the set further. When a listener raises, the
+    exception is logged and the other listeners are still called.
+
+    Non-mutating operations other than `copy` are not synchronised, e.g.
+    iterating while another thread changes the set may raise.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        self._pending = deque()  # changes whose listeners have yet to be called
+        self._dispatching = False
+
+    @contextmanager
+    def _notify_if_changed(self):
+        with self._lock:
+            with super()._notify_if_changed():
+                yield
+        self._dispatch()
+
+    def _notify(self, added, removed):
+        if added or removed:
+            self._pending.append((added, removed))
+
+    def _apply_delta(self, added, removed):
+        with self._lock:
+            super()._apply_delta(added, removed)
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            if self._dispatching:
+                return
+            self._dispatching = True
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._dispatching = False
+                        return
+                    added, removed = self._pending.popleft()
+                for listener in tuple(self._change_listeners):
+                    try:
+                        listener(added=added, removed=removed)
+                    except Exception:
+                        _logger.exception('Change listener raised, ignoring')
+        except BaseException:
+            with self._lock:
+                self._dispatching = False
+            raise
+
+    def copy(self):
+        with self._lock:
+            return super().copy()
+
+def filter(predicate, set_):
+    '''
+    Get a view of the items of an observable set which match a predicate.
+
+    The view is kept up to date with each change to ``set_`` in
+    O(size of the change), rather than recomputing it from scratch.
+
+    Parameters
+    ----------
+    predicate : ~typing.Callable[[~typing.Any], bool]
+        Deterministic function which returns whether an item belongs in the
+        view.
+    set_ : Set
+        Set to view.
+
+    Returns
+    -------
+    Set
+        Observable set of the items of ``set_`` matching ``predicate``. It
+        should not be modified directly. When one of its listeners raises,
+        the change to ``set_`` is rolled back as well, and vice versa.
+    '''
+    view = Set(item for item in set_ if predicate(item))
+    def on_changed(added, removed):
+        view._apply_delta(
+            frozenset(item for item in added if predicate(item)),
+            removed & view,
+        )
+    def rollback(added, removed):
+        view._undo(
+            frozenset(item for item in added if predicate(item)),
+            frozenset(item for item in removed if predicate(item)),
+        )
+    on_changed.rollback = rollback
+    set_.change_listeners.append(on_changed)
+    return view
+
+def map(function, set_):
+    '''
+    Get a view of the items of an observable set mapped by a function.
+
+    The view is kept up to date with each change to ``set_`` in
+    O(size of the change), rather than recomputing it from scratch.
+
+    Parameters
+    ----------
+    function : ~typing.Callable[[~typing.Any], ~typing.Hashable]
+        Deterministic function to apply to each item. Multiple items may map
+        to the same value.
+    set_ : Set
+        Set to view.
+
+    Returns
+    -------
+    Set
+        Observable set of ``function(item)`` for each item in ``set_``. It
+        should not be modified directly. When one of its listeners raises,
+        the change to ``set_`` is rolled back as well, and vice versa.
+    '''
+    counts = Counter(function(item) for item in set_)
+    view = Set(counts)
+    def on_changed(added, removed):
+        _apply_counted_delta(
+            view, counts, 1,
+            (function(item) for item in added),
+            (function(item) for item in removed),
+        )
+    def rollback(added, removed):
+        _apply_counted_delta(
+            view, counts, 1,
+            (function(item) for item in removed),
+            (function(item) for item in added),
+            undo=True,
+        )
+    on_changed.rollback = rollback
+    set_.change_listeners.append(on_changed)
+    return view
+
+def union(*sets):
+    '''
+    Get a view of the union of observable sets.
+
+    The view is kept up to date with each change to any of ``sets`` in
+    O(size of the change), rather than recomputing it from scratch.
+
+    Parameters
+    ----------
+    sets : ~typing.Iterable[Set]
+        Sets to view.
+
+    Returns
+    -------
+    Set
+        Observable set of items which are in any of ``sets``. It should not be
+        modified directly. When one of its listeners raises, the change to
+        the viewed set is rolled back as well, and vice versa.
+    '''
+    return _counted_view(sets, threshold=1)
+
+def intersection(*sets):
+    '''
+    Get a view of the intersection of observable sets.
+
+    The view is kept up to date with each change to any of ``sets`` in
+    O(size of the change), rather than recomputing it from scratch.
+
+    Parameters
+    ----------
+    sets : ~typing.Iterable[Set]
+        Sets to view, at least one.
+
+    Returns
+    -------
+    Set
+        Observable set of items which are in all of ``sets``. It should not be
+        modified directly. When one of its listeners raises, the change to
+        the viewed set is rolled back as well, and vice versa.
+    '''
+    if not sets:
+        raise ValueError('Need at least 1 set to intersect')
+    return _counted_view(sets, threshold=len(sets))
+
+def _counted_view(sets, threshold):
+    '''
+    Get a view of the items which are in at least ``threshold`` of ``sets``.
+    '''
+    counts = Counter(item for set_ in sets for item in set_)
+    view = Set(item for item, count in counts.items() if count >= threshold)
+    def on_changed(added, removed):
+        _apply_counted_delta(view, counts, threshold, added, removed)
+    def rollback(added, removed):
+        _apply_counted_delta(view, counts, threshold, removed, added, undo=True)
+    on_changed.rollback = rollback
+    for set_ in sets:
+        set_.change_listeners.append(on_changed)
+    return view
+
+def _apply_counted_delta(view, counts, threshold, added, removed, undo=False):
+    '''
+    Update item counts and apply the resulting change to the view.
+
+    An item is in the view iff its count is at least ``threshold``. Counts are
+    only updated once the view's listeners accepted the change.
+
+    If ``undo``, the change is the inverse of one which was rolled back, and
+    is applied to the view with `Set._undo` instead.
+    '''
+    new_counts = {}
+    for item in removed:
+        new_counts[item] = new_counts.get(item, counts[item]) - 1
+    for item in added:
+        new_counts[item] = new_counts.get(item, counts[item]) + 1
+    view_added = frozenset(
+        item for item, count in new_counts.items()
+        if count >= threshold > counts[item]
+    )
+    view_removed = frozenset(
+        item for item, count in new_counts.items()
+        if counts[item] >= threshold > count
+    )
+    if undo:
+        view._undo(view_removed, view_added)
+    else:
+        view._apply_delta(view_added, view_removed)
+    for item, count in new_counts.items():
+        if count:
+            counts[item] = count
+        else:
+            del counts[item]
+
+def _merge_deltas(first, second):
+    '''
+    Merge 2 consecutive set changes into their net change.
+
+    Parameters
+    ----------
+    first : ~typing.Tuple[~typing.FrozenSet, ~typing.FrozenSet]
+        Added and removed items of the first change.
+    second : ~typing.Tuple[~typing.FrozenSet, ~typing.FrozenSet]
+        Added and removed items of the change which followed it.
+
+    Returns
+    -------
+    ~typing.Tuple[~typing.FrozenSet, ~typing.FrozenSet]
+        Added and removed items of both changes combined.
+    '''
+    added1, removed1 = first
+    added2, removed2 = second
+    added = (added1 - removed2) | (added2 - removed1)
+    removed = (removed1 - added2) | (removed2 - added1)
+    return added, removed
+
+class AsyncListener:
+
+    '''
+    `Set` change listener which calls a listener on an event loop.
+
+    The listener is called on the loop instead of inside the mutating call,
+    so a slow listener does not block whoever changes the set. Changes are
+    passed to the listener in the order they were made. Unlike regular
+    listeners, it cannot roll back changes; exceptions it raises are passed to
+    the loop's exception handler instead. When a later listener rolls back a
+    change, it is dropped if not yet passed to the listener, else its inverse
+    is passed as well.
+
+    It is safe to change the set from other threads than the loop's.
+
+    Parameters
+    ----------
+    listener : ~typing.Callable[[~typing.FrozenSet, ~typing.FrozenSet], ~typing.Any]
+        Listener to call with the ``added`` and ``removed`` items. If it is a
+        coroutine function, it is awaited on the loop.
+    loop : asyncio.AbstractEventLoop
+        Loop to call the listener on. Defaults to the running loop.
+    executor : concurrent.futures.Executor
+        If given, a listener which is not a coroutine function is called in
+        this executor instead of on the loop.
+    maxsize : int
+        Maximum number of pending changes, 0 for unlimited. When there are
+        too many pending changes, the mutating call raises
+        `asyncio.QueueFull`, rolling back the change, unless ``coalesce``.
+    coalesce : bool
+        If True, when there are too many pending changes, merge them into a
+        single change instead of raising. The listener then only sees their
+        net change, e.g. an item added and removed again is not passed at all.
+
+    Examples
+    --------
+    >>> async def on_changed(added, removed):
+    ...     await db.sync(added, removed)
+    >>> set_.change_listeners.append(AsyncListener(on_changed, maxsize=1, coalesce=True))
+    '''
+
+    def __init__(self, listener, loop=None, executor=None, maxsize=0, coalesce=False):
+        self._listener = listener
+        self._loop = loop or asyncio.get_running_loop()
+        self._executor = executor
+        self._maxsize = maxsize
+        self._coalesce = coalesce
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._scheduled = False  # whether a drain is scheduled or running
+        self._task = None
+
+    @property
+    def pending(self):
+        '''
+        Get the number of changes not yet passed to the listener.
+
+        Returns
+        -------
+        int
+        '''
+        return len(self._pending)
+
+    def __call__(self, added, removed):
+        self._enqueue(added, removed)
+
+    def rollback(self, added, removed):
+        with self._lock:
+            if self._pending and self._pending[-1][0] is added and self._pending[-1][1] is removed:
+                self._pending.pop()
+                return
+        # Already passed to the listener or coalesced, pass the inverse
+        self._enqueue(removed, added, force=True)
+
+    def _enqueue(self, added, removed, force=False):
+        '''
+        Queue change for the listener.
+
+        If ``force``, ``maxsize`` is ignored unless ``coalesce``.
+        '''
+        with self._lock:
+            if self._maxsize and len(self._pending) >= self._maxsize:
+                if not self._coalesce:
+                    if not force:
+                        raise asyncio.QueueFull()
+                else:
+                    delta = (added, removed)
+                    while self._pending:
+                        delta = _merge_deltas(self._pending.pop(), delta)
+                    added, removed = delta
+                    if not (added or removed):
+                        return
+            self._pending.append((added, removed))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        self._task = self._loop.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._scheduled = False
+                        return
+                    added, removed = self._pending.popleft()
+                try:
+                    if inspect.iscoroutinefunction(self._listener):
+                        await self._listener(added=added, removed=removed)
+                    elif self._executor is not None:
+                        await self._loop.run_in_executor(
+                            self._executor,
+                            partial(self._listener, added=added, removed=removed)
+                        )
+                    else:
+                        self._listener(added=added, removed=removed)
+                except Exception as ex:
+                    self._loop.call_exception_handler({
+                        'message': 'Exception in change listener',
+                        'exception': ex,
+                    })
+        except BaseException:
+            # e.g. cancelled: let the next change schedule a new drain, which
+            # also passes the changes still pending
+            with self._lock:
+                self._scheduled = False
+            raise
+
+    async def join(self):
+        '''
+        Wait until all pending changes have been passed to the listener.
+
+        Must be awaited on the listener's loop. If the drain is cancelled
+        meanwhile, returns with the remaining changes pending until the next
+        change.
+        '''
+        while True:
+            with self._lock:
+                if not self._scheduled:
+                    return
+            task = self._task
+            if task is None or task.done():
+                await asyncio.sleep(0)  # let the loop start the drain
+            else:
+                await asyncio.wait({task})
+
+class Journal:
+
+    '''
+    Append-only log of the changes to a `Set`.
+
+    Each change is recorded with a sequence number, starting from 1. Late
+    listeners can catch up from a sequence number with `since` instead of
+    copying the whole set, and a set can be restored from a snapshot and the
+    changes made after it with `replay`.
+
+    Add the journal as the last change listener of the set, so that changes
+    rolled back by other listeners are not recorded.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        If given, changes are appended to this file instead of kept in memory,
+        continuing from any changes already in it. They are read back through
+        a memory map.
+
+    Examples
+    --------
+    >>> journal = Journal(Path('members.journal'))
+    >>> set_.change_listeners.append(journal)
+    >>> snapshot, seq = frozenset(set_), journal.seq
+    >>> set_.add(1)
+
+    Then later, e.g. after a restart:
+
+    >>> set_ = Set(snapshot)
+    >>> with Journal(Path('members.journal')) as journal:
+    ...     journal.replay(set_, since=seq)
+    '''
+
+    def __init__(self, path=None):
+        self._path = path
+        self._entries = []  # changes, if not using a file
+        self._offsets = array('Q')  # offset of each change's record, if using a file
+        self._first_seq = 1
+        self._file = None
+        if path is not None:
+            end = 0
+            with suppress(FileNotFoundError):
+                for offset, seq, _, end in self._records():
+                    if not self._offsets:
+                        self._first_seq = seq
+                    self._offsets.append(offset)
+            self._file = path.open('ab')
+            self._file.truncate(end)  # drop incomplete record left by a crash
+            self._file.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        'Close the journal file, if any'
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def seq(self):
+        '''
+        Get the sequence number of the last recorded change.
+
+        Returns
+        -------
+        int
+            Sequence number, 0 if no changes were recorded.
+        '''
+        return self._first_seq + len(self._offsets if self._path else self._entries) - 1
+
+    def __call__(self, added, removed):
+        if self._file is None:
+            self._entries.append((added, removed))
+        else:
+            payload = pickle.dumps((added, removed), pickle.HIGHEST_PROTOCOL)
+            offset = self._file.tell()
+            self._file.write(_journal_header.pack(self.seq + 1, len(payload)) + payload)
+            self._file.flush()
+            self._offsets.append(offset)
+
+    def _records(self, offset=0):
+        'Iterate (offset, seq, payload, end) of the complete records in the file, from offset'
+        with self._path.open('rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if offset >= size:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as map_:
+                while offset + _journal_header.size <= size:
+                    seq, length = _journal_header.unpack_from(map_, offset)
+                    start = offset + _journal_header.size
+                    end = start + length
+                    if end > size:
+                        return
+                    yield offset, seq, map_[start:end], end
+                    offset = end
+
+    def since(self, seq):
+        '''
+        Iterate over the changes recorded after a sequence number.
+
+        Parameters
+        ----------
+        seq : int
+            Sequence number of the last change already seen, 0 for all changes.
+
+        Yields
+        ------
+        ~typing.Tuple[int, ~typing.FrozenSet, ~typing.FrozenSet]
+            Sequence number, added items and removed items of each change.
+        '''
+        index = max(seq - self._first_seq + 1, 0)
+        if self._file is None:
+            for i in range(index, len(self._entries)):
+                added, removed = self._entries[i]
+                yield self._first_seq + i, added, removed
+        elif index < len(self._offsets):
+            for _, seq_, payload, _ in self._records(self._offsets[index]):
+                added, removed = pickle.loads(payload)
+                yield seq_, added, removed
+
+    def replay(self, set_, since=0):
+        '''
+        Apply the changes recorded after a sequence number to a set.
+
+        Listeners of ``set_`` are notified of each change.
+
+        Parameters
+        ----------
+        set_ : Set
+            Set to apply the changes to, e.g. a snapshot of the original set
+            taken at sequence number ``since``.
+        since : int
+            Sequence number of the last change already applied to ``set_``.
+
+        Returns
+        -------
+        int
+            Sequence number of the last applied change.
+        '''
+        for since, added, removed in self.since(since):
+            set_._apply_delta(added - set_, removed & set_)
+        return since
+
+class Dict(_Observable, dict):
+
+    'Observable dict'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._change_listeners = _ChangeListeners()
+
+    @property
+    def change_listeners(self):
+        '''
+        Get change listeners.
+
+        Each change listener is called immediately after a mutating operation
+        that actually changed the dict. E.g. setting a key to a value equal to
+        its current value is ignored.
+
+        Returns
+        -------
+        ~typing.List[~typing.Callable[[~typing.Dict, ~typing.Dict, ~typing.Dict], None]]
+            List of change listeners. Each change listener takes 3 arguments:
+            the items that were added, the items that were removed and the
+            items whose value changed. The latter maps each key to a tuple of
+            its old and new value. When a listener raises, the change is rolled
+            back without further notification.
+        '''
+        return self._change_listeners
+
+    @contextmanager
+    def _notify_if_changed(self, keys, removes=False):
+        # Only remember the keys the operation can change, not a full copy.
+        # Except if it can remove keys, then their order is needed to roll back
+        original = {key: self.get(key, _missing) for key in keys}
+        order = tuple(self) if removes and self._change_listeners else None
+        yield
+        self._notify(original, order)
+
+    def _notify(self, original, order=None):
+        '''
+        Notify listeners of changes to the given keys.
+
+        Parameters
+        ----------
+        original : ~typing.Dict
+            The value of each key before the change, `_missing` if it was
+            missing.
+        order : ~typing.Tuple or None
+            Keys in order before the change, if it may have removed keys other
+            than the last one.
+        '''
+        added = {}
+        removed = {}
+        changed = {}
+        for key, old in original.items():
+            new = self.get(key, _missing)
+            if old is _missing:
+                if new is not _missing:
+                    added[key] = new
+            elif new is _missing:
+                removed[key] = old
+            elif not _equals(new, old):
+                changed[key] = (old, new)
+        if added or removed or changed:
+            for listener in tuple(self._change_listeners):
+                try:
+                    listener(added=added, removed=removed, changed=changed)
+                except Exception as ex:
+                    if removed and order is not None:
+                        # Reinsert removed keys where they were
+                        items = {
+                            key: self[key] if original.get(key, _missing) is _missing else original[key]
+                            for key in order
+                        }
+                        super().clear()
+                        super().update(items)
+                    else:
+                        for key, old in original.items():
+                            if old is _missing:
+                                super().pop(key, None)
+                            else:
+                                super().__setitem__(key, old)
+                    raise ex
+
+    def __setitem__(self, key, value):
+        with self._notify_if_changed((key,)):
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._notify_if_changed((key,), removes=True):
+            super().__delitem__(key)
+
+    def pop(self, key, *args):
+        with self._notify_if_changed((key,), removes=True):
+            return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._notify({key: value})
+        return key, value
+
+    def setdefault(self, key, default=None):
+        with self._notify_if_changed((key,)):
+            return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        with self._notify_if_changed(other):
+            super().update(other)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        with self._notify_if_changed(tuple(self), removes=True):
+            super().clear()
+
+class List(_Observable, list):
+
+    'Observable list'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._change_listeners = _ChangeListeners()
+
+    @property
+    def change_listeners(self):
+        '''
+        Get change listeners.
+
+        Each change listener is called immediately after a mutating operation
+        that actually changed the list. E.g. sorting a sorted list is ignored.
+
+        Returns
+        -------
+        ~typing.List[~typing.Callable[[int, ~typing.Tuple, ~typing.Tuple], None]]
+            List of change listeners. Each change listener takes 3 arguments
+            describing a splice: the index at which items were replaced, the
+            items that were removed and the items that were added. I.e. after
+            the change, ``list[index:index+len(added)] == added`` where before
+            ``list[index:index+len(removed)] == removed``. When a listener
+            raises, the change is rolled back without further notification.
+        '''
+        return self._change_listeners
+
+    def _splice(self, start, stop, items):
+        'Replace ``self[start:stop]`` by items and notify'
+        removed = tuple(super().__getitem__(slice(start, stop)))
+        added = tuple(items)
+        super().__setitem__(slice(start, stop), added)
+        if len(removed) == len(added) and all(_equals(old, new) for old, new in zip(removed, added)):
+            return
+        for listener in tuple(self._change_listeners):
+            try:
+                listener(index=start, removed=removed, added=added)
+            except Exception as ex:
+                super().__setitem__(slice(start, start + len(added)), removed)
+                raise ex
+
+    def _index(self, index, message='list index out of range'):
+        'Get index as non-negative int'
+        try:
+            return range(len(self))[index]
+        except IndexError:
+            raise IndexError(message) from None
+
+    def _extended_slice(self, slice_):
+        '''
+        Get the indices of an extended slice and the smallest range covering
+        them.
+        '''
+        indices = range(len(self))[slice_]
+        if not indices:
+            return indices, 0, 0
+        return indices, min(indices), max(indices) + 1
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                self._splice(start, max(start, stop), value)
+                return
+            values = tuple(value)
+            indices, start, stop = self._extended_slice(index)
+            if len(values) != len(indices):
+                raise ValueError(
+                    f'attempt to assign sequence of size {len(values)} to '
+                    f'extended slice of size {len(indices)}'
+                )
+            items = list(super().__getitem__(slice(start, stop)))
+            for i, item in zip(indices, values):
+                items[i - start] = item
+            self._splice(start, stop, items)
+        else:
+            index = self._index(index, 'list assignment index out of range')
+            self._splice(index, index + 1, (value,))
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                self._splice(start, max(start, stop), ())
+                return
+            indices, start, stop = self._extended_slice(index)
+            deleted = set(indices)
+            items = [
+                item
+                for i, item in enumerate(super().__getitem__(slice(start, stop)), start)
+                if i not in deleted
+            ]
+            self._splice(start, stop, items)
+        else:
+            index = self._index(index, 'list assignment index out of range')
+            self._splice(index, index + 1, ())
+
+    def append(self, item):
+        self._splice(len(self), len(self), (item,))
+
+    def extend(self, items):
+        self._splice(len(self), len(self), items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, n):
+        if n <= 0:
+            self.clear()
+        else:
+            self.extend(list(self) * (n - 1))
+        return self
+
+    def insert(self, index, item):
+        if index < 0:
+            index = max(0, len(self) + index)
+        else:
+            index = min(index, len(self))
+        self._splice(index, index, (item,))
+
+    def pop(self, index=-1):
+        if not self:
+            raise IndexError('pop from empty list')
+        index = self._index(index, 'pop index out of range')
+        item = self[index]
+        self._splice(index, index + 1, ())
+        return item
+
+    def remove(self, item):
+        try:
+            index = self.index(item)
+        except ValueError:
+            raise ValueError('list.remove(x): x not in list') from None
+        self._splice(index, index + 1, ())
+
+    def clear(self):
+        self._splice(0, len(self), ())
+
+    def sort(self, *, key=None, reverse=False):
+        self._splice(0, len(self), sorted(self, key=key, reverse=reverse))
+
+    def reverse(self):
+        self._splice(0, len(self), self[::-1])
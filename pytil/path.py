@@ -18,13 +18,35 @@
 '`python:pathlib` extensions'
 
 from contextlib import suppress, contextmanager
-from pathlib import Path
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from itertools import chain
+from stat import S_ISLNK, S_ISDIR, S_IFMT, S_IFDIR, S_IFREG, S_IFLNK
+from pathlib import Path, PurePath
+from array import array
+import threading
 import tempfile
+import shutil
+import asyncio
+import logging
+import heapq
 import hashlib
+import sqlite3
+import pickle
+import json
 import errno
 import time
 import os
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+_logger = logging.getLogger(__name__)
 
 #: The file system root to use (used for testing)
 _root = Path('/')
@@ -33,12 +55,13 @@ _root = Path('/')
 # others probably don't
 # https://plumbum.readthedocs.org/en/latest/utils.html
 
-def remove(path, force=False):
+def remove(path, force=False, executor=None, nfs_poll=.1, nfs_max_poll=5, nfs_timeout=None, progress=None):
     '''
     Remove file or directory (recursively), if it exists.
 
     On NFS file systems, if a directory contains :file:`.nfs*` temporary files
     (sometimes created when deleting a file), it waits for them to go away.
+    Such directories are left until the rest of the tree has been removed.
 
     Parameters
     ----------
@@ -47,51 +70,354 @@ def remove(path, force=False):
     force : bool
         If True, will remove files and directories even if they are read-only
         (as if first doing ``chmod -R +w``).
+    executor : concurrent.futures.Executor
+        If given, remove the files of a directory concurrently in this
+        `~concurrent.futures.ThreadPoolExecutor`. Directories are removed as
+        soon as their children are gone.
+    nfs_poll : float
+        Seconds to wait before checking again whether :file:`.nfs*` files
+        have gone away. The wait doubles after each check.
+    nfs_max_poll : float
+        Max seconds to wait between checks for :file:`.nfs*` files.
+    nfs_timeout : float or None
+        Max seconds for the whole removal when waiting for :file:`.nfs*`
+        files, after which `TimeoutError` is raised. `None` to wait
+        indefinitely.
+    progress : ~typing.Callable[[int], None]
+        If given, called with the number of files (and symlinks) removed since
+        the last call. If it raises, removal stops and the exception is
+        reraised.
+
+    See also
+    --------
+    remove_async : Remove without blocking the event loop
+    '''
+    deadline = None if nfs_timeout is None else time.monotonic() + nfs_timeout
+    for delay in _remove(path, force, executor, nfs_poll, nfs_max_poll, deadline, progress):
+        time.sleep(delay)
+
+async def remove_async(
+    path, force=False, executor=None, nfs_poll=.1, nfs_max_poll=5, nfs_timeout=None, max_workers=None, progress=None
+):
+    '''
+    Remove file or directory (recursively), if it exists, without blocking the
+    event loop.
+
+    Like `remove`, but runs in the loop's default executor and waits for
+    :file:`.nfs*` files with `asyncio.sleep`, so other work carries on. When
+    cancelled, removal stops at the next file or directory removed, before
+    the cancellation completes. Tasks submitted to ``executor`` which have not
+    started yet are cancelled; those already running may still finish
+    afterwards.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        See `remove`.
+    force : bool
+        See `remove`.
+    executor : concurrent.futures.Executor
+        See `remove`.
+    nfs_poll : float
+        See `remove`.
+    nfs_max_poll : float
+        See `remove`.
+    nfs_timeout : float or None
+        See `remove`.
+    max_workers : int or None
+        If given and no ``executor`` is given, remove files concurrently in a
+        thread pool of this many threads.
+    progress : ~typing.Callable[[int], None]
+        If given, called on the event loop like the ``progress`` of `remove`.
+    '''
+    deadline = None if nfs_timeout is None else time.monotonic() + nfs_timeout
+    await _run_async(
+        lambda executor, progress: _remove(path, force, executor, nfs_poll, nfs_max_poll, deadline, progress),
+        executor, max_workers, progress
+    )
+
+async def _run_async(steps, executor, max_workers, progress):
+    '''
+    Run blocking filesystem work without blocking the event loop.
+
+    Parameters
+    ----------
+    steps : ~typing.Callable[[concurrent.futures.Executor, ~typing.Callable[[int], None]], ~typing.Generator[float, None, T]]
+        Called with an executor and a progress callback. Returns a generator
+        which yields seconds to wait before resuming it and returns the
+        result. Each step is run in the loop's default executor.
+    executor : concurrent.futures.Executor or None
+        Executor to pass to ``steps``. If `None` and ``max_workers`` is given,
+        a thread pool of ``max_workers`` threads is passed instead.
+    max_workers : int or None
+        See ``executor``.
+    progress : ~typing.Callable[[int], None] or None
+        Called on the event loop with each count ``steps`` reports.
+
+    Returns
+    -------
+    T
+        Return value of the generator.
+    '''
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    def report(count):
+        # Called by the work, so raising stops it
+        if cancelled.is_set():
+            raise asyncio.CancelledError()
+        if progress is not None:
+            loop.call_soon_threadsafe(progress, count)
+    pool = None
+    if executor is None and max_workers:
+        executor = pool = ThreadPoolExecutor(max_workers)
+    generator = steps(executor, report)
+    def step():
+        try:
+            return False, next(generator)
+        except StopIteration as ex:
+            return True, ex.value
+    try:
+        while True:
+            future = loop.run_in_executor(None, step)
+            try:
+                done, value = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Wait for the work to notice and stop
+                cancelled.set()
+                with suppress(Exception, asyncio.CancelledError):
+                    await future
+                raise
+            if done:
+                return value
+            await asyncio.sleep(value)
+    finally:
+        generator.close()
+        if pool is not None:
+            await loop.run_in_executor(None, _shutdown, pool)
+
+def _shutdown(executor):
+    'Shut down executor, cancelling tasks which have not started yet'
+    try:
+        executor.shutdown(cancel_futures=True)
+    except TypeError:  # cancel_futures requires Python 3.9
+        executor.shutdown()
+
+def _cancel(futures):
+    'Cancel futures, so that those which have not started yet do not run'
+    for future in futures:
+        future.cancel()
+
+def _without_waits(function, *args):
+    'Generator for `_run_async` which calls function without waiting'
+    return function(*args)
+    yield  # pylint: disable=unreachable
+
+def _remove(path, force, executor, nfs_poll, nfs_max_poll, deadline, progress):
+    '''
+    Remove file or directory.
+
+    Generator which yields how many seconds to wait before checking again
+    whether :file:`.nfs*` files have gone away.
     '''
     if not path.exists():
         return
     else:
         if force:
             with suppress(FileNotFoundError):
-                chmod(path, 0o700, '+', recursive=True)
+                chmod(path, 0o700, '+', recursive=True, executor=executor)
         if path.is_dir() and not path.is_symlink():
             # Note: shutil.rmtree did not handle NFS well
+            root = str(path)
+            if executor is not None:
+                deferred = _ConcurrentRemoval(executor).run(root, progress)
+                if not deferred and os.path.lexists(root):
+                    # Something was left behind, e.g. an unreadable
+                    # directory, remove the rest sequentially to get the error
+                    deferred = _remove_tree(root, progress)
+            else:
+                deferred = _remove_tree(root, progress)
+            yield from _remove_deferred(deferred, nfs_poll, nfs_max_poll, deadline)
+        else:
+            with suppress(FileNotFoundError):
+                path.unlink()
+            if progress is not None:
+                progress(1)
+
+def _remove_tree(root, progress=None):
+    '''
+    Remove directory tree, except for directories with lingering .nfs* files.
 
-            # First remove all files
-            for dir_, dirs, files in os.walk(str(path), topdown=False): # bottom-up walk
-                dir_ = Path(dir_)
-                for file in files:
-                    with suppress(FileNotFoundError):
-                        (dir_ / file).unlink()
-                for file in dirs:  # Note: os.walk treats symlinks to directories as directories
-                    file = dir_ / file
-                    if file.is_symlink():
-                        with suppress(FileNotFoundError):
-                            file.unlink()
-
-            # Now remove all dirs, being careful of any lingering .nfs* files
-            for dir_, _, _ in os.walk(str(path), topdown=False): # bottom-up walk
-                dir_ = Path(dir_)
+    Returns
+    -------
+    ~typing.List[str]
+        Directories which could not be removed yet, descendants first.
+    '''
+    deferred = []
+    blocked = set()  # directories with deferred children
+    for directory, fd, directories, files in _walk(root, topdown=False):
+        for entry in files:
+            with suppress(FileNotFoundError):
+                os.unlink(entry.name, dir_fd=fd)
+        removed = len(files)
+        for entry in directories:
+            if entry.is_symlink():
                 with suppress(FileNotFoundError):
-                    # wait for .nfs* files
-                    children = list(dir_.iterdir())
+                    os.unlink(entry.name, dir_fd=fd)
+                removed += 1
+            else:
+                subdirectory = os.path.join(directory, entry.name)
+                if subdirectory in blocked or not _try_remove_directory(subdirectory):
+                    deferred.append(subdirectory)
+                    blocked.add(directory)
+        if progress is not None and removed:
+            progress(removed)
+    if root in blocked or not _try_remove_directory(root):
+        deferred.append(root)
+    return deferred
 
-                    while children:
-                        # only wait for nfs temporary files
-                        if any(not child.name.startswith('.nfs') for child in children):
-                            dir_.rmdir()  # raises dir not empty
+class _ConcurrentRemoval:
 
-                        # wait and go again
-                        time.sleep(.1)
-                        children = list(dir_.iterdir())
+    '''
+    Remove directory tree, unlinking files concurrently.
 
-                    # rm
-                    dir_.rmdir()
-        else:
-            with suppress(FileNotFoundError):
-                path.unlink()
+    Each directory is removed by whichever task removes its last child.
+    '''
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._pending = {}  # directory -> number of its children yet to be removed
+        self._parents = {}  # directory -> its parent directory
+        self._deferred = []  # directories with lingering .nfs* files
+        self._futures = deque()
+
+    def run(self, root, progress=None):
+        '''
+        Remove root and its descendants, raise the first error if any.
+
+        ``progress`` is called with 1 per file or symlink removed, also while
+        still walking the tree. If it raises, tasks which have not started yet
+        are cancelled and the exception is reraised.
+
+        Returns
+        -------
+        ~typing.List[str]
+            Directories which could not be removed yet because of lingering
+            .nfs* files, and their ancestors, descendants first.
+        '''
+        def report_done(wait=False):
+            while self._futures and (wait or self._futures[0].done()):
+                if self._futures.popleft().result() and progress is not None:
+                    progress(1)
+        try:
+            for directory, _, directories, files in _walk(root):
+                subdirectories = [entry for entry in directories if not entry.is_symlink()]
+                links = [entry for entry in directories if entry.is_symlink()]
+                children = len(subdirectories) + len(links) + len(files)
+                with self._lock:
+                    self._pending[directory] = children
+                    for entry in subdirectories:
+                        self._parents[os.path.join(directory, entry.name)] = directory
+                if not children:
+                    self._submit(self._remove_directory, directory)
+                for entry in chain(files, links):
+                    self._submit(self._unlink, os.path.join(directory, entry.name), directory)
+                report_done()
+            report_done(wait=True)
+        except BaseException:
+            _cancel(self._futures)
+            raise
+        deferred = set()
+        for directory in self._deferred:
+            while directory is not None and directory not in deferred:
+                deferred.add(directory)
+                directory = self._parents.get(directory)
+        return sorted(deferred, key=lambda directory: directory.count(os.sep), reverse=True)
+
+    def _submit(self, function, *args):
+        self._futures.append(self._executor.submit(function, *args))
+
+    def _unlink(self, path, directory):
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        self._child_removed(directory)
+        return True
+
+    def _remove_directory(self, directory):
+        if not _try_remove_directory(directory):
+            with self._lock:
+                self._deferred.append(directory)
+            return
+        with self._lock:
+            parent = self._parents.pop(directory, None)
+        if parent is not None:
+            self._child_removed(parent)
+
+    def _child_removed(self, directory):
+        with self._lock:
+            self._pending[directory] -= 1
+            empty = not self._pending[directory]
+            if empty:
+                del self._pending[directory]
+        if empty:
+            self._remove_directory(directory)
+
+def _try_remove_directory(directory):
+    '''
+    Remove empty directory.
+
+    Returns
+    -------
+    bool
+        False if not removed because it contains .nfs* files, which may go away
+        later, True if removed or already gone.
+    '''
+    try:
+        os.rmdir(directory)
+    except FileNotFoundError:
+        pass
+    except OSError as ex:
+        if ex.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+        try:
+            children = os.listdir(directory)
+        except FileNotFoundError:
+            return True
+        # only wait for nfs temporary files
+        if any(not child.startswith('.nfs') for child in children):
+            raise
+        return False
+    return True
+
+def _remove_deferred(directories, nfs_poll, nfs_max_poll, deadline):
+    '''
+    Remove directories, waiting for lingering .nfs* files to go away.
+
+    Generator which yields how many seconds to wait before trying again.
 
-def chmod(path, mode, operator='=', recursive=False):
+    Parameters
+    ----------
+    directories : ~typing.List[str]
+        Directories to remove, descendants first.
+    '''
+    delay = nfs_poll
+    while directories:
+        remaining = []
+        blocked = set()  # directories with remaining children
+        for directory in directories:
+            if directory in blocked or not _try_remove_directory(directory):
+                remaining.append(directory)
+                blocked.add(os.path.dirname(directory))
+        directories = remaining
+        if directories:
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    errno.ETIMEDOUT, 'Timed out waiting for .nfs* files to go away', directories[0]
+                )
+            yield delay
+            delay = min(delay * 2, nfs_max_poll)
+
+def chmod(path, mode, operator='=', recursive=False, executor=None, progress=None):
     '''
     Change file mode bits.
 
@@ -119,38 +445,228 @@ def chmod(path, mode, operator='=', recursive=False):
 
     recursive : bool
         Whether to chmod recursively.
+    executor : concurrent.futures.Executor
+        If given, chmod files concurrently in this
+        `~concurrent.futures.ThreadPoolExecutor` when ``recursive``.
+    progress : ~typing.Callable[[int], None]
+        If given, called with the number of files and directories chmodded
+        (or, with an ``executor``, submitted to be chmodded) since the last
+        call. If it raises, chmodding stops and the exception is reraised.
+
+    See also
+    --------
+    chmod_async : Chmod without blocking the event loop
     '''
     if mode > 0o777 and operator != '=':
         raise ValueError('Special bits (i.e. >0o777) only supported when using "=" operator')
 
     # first chmod path
-    if operator == '+':
-        mode_ = path.stat().st_mode | mode
-    elif operator == '-':
-        mode_ = path.stat().st_mode & ~mode
-    else:
-        mode_ = mode
-    if path.is_symlink():
+    stat_ = os.lstat(str(path))
+    if S_ISLNK(stat_.st_mode):
         # Do not chmod or follow symlinks
         return
-    path.chmod(mode_)
+    os.chmod(str(path), _apply_mode(stat_.st_mode, mode, operator))
+    if progress is not None:
+        progress(1)
 
     # then its children
-    def chmod_children(parent, files, mode_mask, operator):
-        for file in files:
+    if recursive and S_ISDIR(stat_.st_mode):
+        futures = []  # [(future, its fd)]
+        try:
+            for _, fd, directories, files in _walk(str(path)):
+                # Directories must be chmodded before the walk lists them
+                _chmod_children(fd, _names(directories), mode, operator)
+                files = _names(files)
+                file_mode = mode & 0o777666
+                if executor is None:
+                    _chmod_children(fd, files, file_mode, operator)
+                else:
+                    for i in range(0, len(files), _chmod_batch_size):
+                        batch = files[i:i+_chmod_batch_size]
+                        # The walk closes fd, so give the task its own
+                        fd_ = os.dup(fd)
+                        futures.append((executor.submit(_chmod_children, fd_, batch, file_mode, operator, True), fd_))
+                if progress is not None:
+                    progress(len(directories) + len(files))
+            for future, _ in futures:
+                future.result()
+        except BaseException:
+            # Cancel tasks which have not started yet, closing their fd
+            for future, fd_ in futures:
+                if future.cancel():
+                    os.close(fd_)
+            raise
+
+async def chmod_async(path, mode, operator='=', recursive=False, executor=None, max_workers=None, progress=None):
+    '''
+    Change file mode bits without blocking the event loop.
+
+    Like `chmod`, but runs in the loop's default executor. When cancelled,
+    chmodding stops at the next directory, before the cancellation completes.
+    Tasks submitted to ``executor`` which have not started yet are cancelled;
+    those already running may still finish afterwards.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        See `chmod`.
+    mode : int
+        See `chmod`.
+    operator : str
+        See `chmod`.
+    recursive : bool
+        See `chmod`.
+    executor : concurrent.futures.Executor
+        See `chmod`.
+    max_workers : int or None
+        If given and no ``executor`` is given, chmod files concurrently in a
+        thread pool of this many threads.
+    progress : ~typing.Callable[[int], None]
+        If given, called on the event loop like the ``progress`` of `chmod`.
+    '''
+    await _run_async(
+        lambda executor, progress: _without_waits(chmod, path, mode, operator, recursive, executor, progress),
+        executor, max_workers, progress
+    )
+
+#: Max number of files per task submitted by `chmod`
+_chmod_batch_size = 256
+
+def _names(entries):
+    'Get names of directory entries, except symlinks'
+    return [entry.name for entry in entries if not entry.is_symlink()]
+
+def _apply_mode(current, mode, operator):
+    'Get new mode of file given its current mode'
+    if operator == '+':
+        return current | mode
+    elif operator == '-':
+        return current & ~mode
+    else:
+        return mode
+
+def _chmod_children(dir_fd, names, mode, operator, close=False):
+    '''
+    Chmod children of directory.
+
+    Parameters
+    ----------
+    dir_fd : int
+        File descriptor of the directory.
+    names : ~typing.Iterable[str]
+        Names of the children to chmod, none of which should be symlinks.
+    close : bool
+        Whether to close ``dir_fd`` when done.
+    '''
+    try:
+        for name in names:
             with suppress(FileNotFoundError):
-                file = parent / file
-                if not file.is_symlink():
-                    chmod(file, mode & mode_mask, operator)
-    if recursive and path.is_dir():
-        for parent, dirs, files in os.walk(str(path)):
-            parent = Path(parent)
-            chmod_children(parent, dirs, 0o777777, operator)
-            chmod_children(parent, files, 0o777666, operator)
+                if operator == '=':
+                    mode_ = mode
+                else:
+                    mode_ = _apply_mode(os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode, mode, operator)
+                if _chmod_follow_symlinks:
+                    os.chmod(name, mode_, dir_fd=dir_fd)
+                else:
+                    os.chmod(name, mode_, dir_fd=dir_fd, follow_symlinks=False)
+    finally:
+        if close:
+            os.close(dir_fd)
+
+#: Whether os.chmod must follow symlinks, in which case there is a tiny window
+#: for an entry to be replaced by a symlink after checking it is not one
+_chmod_follow_symlinks = os.chmod not in os.supports_follow_symlinks
+
+def _walk(path, topdown=True, onerror=None):
+    '''
+    Walk directory tree like `os.walk`, but with directory entries and file
+    descriptors.
+
+    Children are listed with `os.scandir`, so their type and stat info is
+    cached on their `os.DirEntry`. Directories are opened relative to their
+    parent's file descriptor and can be operated on with ``dir_fd``, saving
+    path lookups.
+
+    Like `os.walk`, directories which cannot be listed are skipped, symlinks to
+    directories are listed as directories but not walked into.
+
+    Parameters
+    ----------
+    path : str
+        Directory to walk.
+    topdown : bool
+        Whether to yield a directory before its subdirectories. If so, the
+        subdirectory list may be modified to prune the walk.
+    onerror : ~typing.Callable[[OSError], None] or None
+        Like the ``onerror`` of `os.walk`: if given, called with the error of
+        opening or listing a directory before skipping it. It may raise to
+        abort the walk.
+
+    Yields
+    ------
+    ~typing.Tuple[str, int, ~typing.List[os.DirEntry], ~typing.List[os.DirEntry]]
+        Directory path, file descriptor of the directory, entries of its
+        subdirectories and entries of its other children. The file descriptor
+        is only valid until the next iteration.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as ex:
+        if onerror is not None:
+            onerror(ex)
+        return
+    try:
+        yield from _walk_fd(path, fd, topdown, onerror)
+    finally:
+        os.close(fd)
+
+def _walk_fd(path, fd, topdown, onerror):
+    try:
+        with os.scandir(fd) as entries:
+            entries = list(entries)
+    except OSError as ex:
+        if onerror is not None:
+            ex.filename = path
+            onerror(ex)
+        return
+    directories = []
+    files = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            directories.append(entry)
+        else:
+            files.append(entry)
+    if topdown:
+        yield path, fd, directories, files
+    for entry in directories:
+        child_path = os.path.join(path, entry.name)
+        try:
+            if entry.is_symlink():
+                continue
+            child_fd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+        except OSError as ex:
+            if onerror is not None:
+                ex.filename = child_path
+                onerror(ex)
+            continue
+        try:
+            yield from _walk_fd(child_path, child_fd, topdown, onerror)
+        finally:
+            os.close(child_fd)
+    if not topdown:
+        yield path, fd, directories, files
+
+def _raise(ex):
+    'Raise ex, for use as ``onerror`` of `_walk`'
+    raise ex
 
 # Used by cedalion
 @contextmanager
-def TemporaryDirectory(suffix=None, prefix=None, dir=None, on_error='ignore'):
+def TemporaryDirectory(suffix=None, prefix=None, dir=None, on_error='ignore', background=False):
     '''
     An extension to `tempfile.TemporaryDirectory`.
 
@@ -172,9 +688,28 @@ def TemporaryDirectory(suffix=None, prefix=None, dir=None, on_error='ignore'):
             Raise exception on failure.
         ignore
             Fail silently.
+
+        Does not apply when ``background``.
+    background : bool
+        If True, on ``__exit__`` the directory is renamed to a tombstone, which
+        is removed in a background thread, retrying on failure. Tombstones left
+        behind, e.g. because the process exited first, are removed by the next
+        ``TemporaryDirectory(background=True)`` in the same ``dir``.
+
+    See also
+    --------
+    wait_for_background_removals : Wait for background removals to finish
     '''
     if dir:
         dir = str(dir)
+    if background:
+        path = Path(tempfile.mkdtemp(suffix, prefix, dir))
+        _background_remover.remove_tombstones(path.parent)
+        try:
+            yield path
+        finally:
+            remove_in_background(path, force=True)
+        return
     temp_dir = tempfile.TemporaryDirectory(suffix, prefix, dir)
     try:
         yield Path(temp_dir.name)
@@ -187,7 +722,194 @@ def TemporaryDirectory(suffix=None, prefix=None, dir=None, on_error='ignore'):
             if on_error != 'ignore' or ex.errno != errno.ENOTEMPTY:
                 raise
 
-def hash(path, hash_function=hashlib.sha512):
+def remove_in_background(path, force=False):
+    '''
+    Remove file or directory in a background thread, if it exists.
+
+    The path is first renamed to a tombstone in the same directory, unless
+    already named as one of the current process, which is then removed,
+    retrying on failure. Tombstones left behind, e.g. because the process
+    exited first, are removed by the next call in the same directory.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        Path to remove.
+    force : bool
+        See `remove`. If False and removal fails with `PermissionError`, it is
+        retried with ``force=True``.
+
+    See also
+    --------
+    wait_for_background_removals : Wait for background removals to finish
+    '''
+    _background_remover.remove_tombstones(path.parent)
+    if path.name.startswith(_own_tombstone_prefix()):  # e.g. by temp_dir_cwd_tmpfs
+        tombstone = path
+    else:
+        tombstone = _tombstone(path)
+    with suppress(FileNotFoundError):
+        path.rename(tombstone)
+        _background_remover.submit(tombstone, force=force)
+
+def wait_for_background_removals(timeout=None):
+    '''
+    Wait for directories of ``TemporaryDirectory(background=True)`` and
+    `remove_in_background` to be removed.
+
+    Parameters
+    ----------
+    timeout : float or None
+        Max seconds to wait, `None` to wait indefinitely.
+
+    Returns
+    -------
+    bool
+        Whether all removals finished, including retries of failed ones. False
+        if the timeout expired first.
+    '''
+    return _background_remover.join(timeout)
+
+#: Name prefix of directories awaiting removal by _BackgroundRemover
+_tombstone_prefix = '.pytil-tombstone-'
+
+def _tombstone(path):
+    '''
+    Get tombstone path of path, owned by the current process.
+
+    Tombstones are named ``{_tombstone_prefix}{pid}-{name}`` so that other
+    processes sharing the directory (e.g. ``/dev/shm``) leave them alone while
+    the process is alive.
+    '''
+    return path.with_name(_own_tombstone_prefix() + path.name)
+
+def _own_tombstone_prefix():
+    'Get name prefix of tombstones owned by the current process'
+    return f'{_tombstone_prefix}{os.getpid()}-'
+
+def _is_orphaned_tombstone(tombstone):
+    '''
+    Get whether tombstone was left behind by a process of the current user which
+    is no longer running.
+    '''
+    pid, _, _ = tombstone.name[len(_tombstone_prefix):].partition('-')
+    if os.name != 'posix' or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        if tombstone.lstat().st_uid != os.getuid():
+            return False
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:  # Removed meanwhile, or running as another user
+        return False
+    return False
+
+class _BackgroundRemover:
+
+    '''
+    Removes paths in a background thread, retrying on failure.
+    '''
+
+    #: Number of attempts to remove a path
+    attempts = 5
+
+    #: Seconds to wait before the first retry, doubles on each retry
+    retry_delay = 1
+
+    #: Max seconds to wait for .nfs* files to go away per attempt, after which
+    #: the removal is retried later instead of blocking other removals
+    nfs_timeout = 30
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._queue = []  # heap of (due time, sequence number, path, force, attempt)
+        self._sequence_number = 0
+        self._busy = False
+        self._thread = None
+        self._tombstone_dirs = set()  # dirs whose leftover tombstones were submitted
+
+    def submit(self, path, force=False, attempt=0, delay=0):
+        '''
+        Remove path in the background.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            Path to remove.
+        force : bool
+            See `remove`.
+        '''
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='pytil-remover', daemon=True)
+                self._thread.start()
+            self._sequence_number += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, self._sequence_number, path, force, attempt))
+            self._condition.notify_all()
+
+    def remove_tombstones(self, directory):
+        '''
+        Submit tombstones left behind in directory by processes which are no
+        longer running, once per directory.
+
+        Each tombstone is first claimed by renaming it to a tombstone of the
+        current process, so that processes sweeping the same directory
+        concurrently do not remove the same tombstone.
+        '''
+        directory = directory.absolute()
+        with self._condition:
+            if directory in self._tombstone_dirs:
+                return
+            self._tombstone_dirs.add(directory)
+        for tombstone in directory.glob(_tombstone_prefix + '*'):
+            if not _is_orphaned_tombstone(tombstone):
+                continue
+            _, _, name = tombstone.name[len(_tombstone_prefix):].partition('-')
+            claimed = _tombstone(tombstone.with_name(name))
+            try:
+                tombstone.rename(claimed)
+            except OSError:  # Claimed by another process
+                continue
+            self.submit(claimed, force=True)
+
+    def join(self, timeout=None):
+        '''
+        Wait until all paths have been removed or given up on.
+
+        Returns
+        -------
+        bool
+            False if the timeout expired first.
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: not (self._queue or self._busy), timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    self._condition.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                _, _, path, force, attempt = heapq.heappop(self._queue)
+                self._busy = True
+            try:
+                remove(path, force=force, nfs_timeout=self.nfs_timeout)
+            except OSError as ex:  # Including TimeoutError
+                if isinstance(ex, PermissionError):
+                    force = True  # Something was read-only after all
+                attempt += 1
+                if attempt < self.attempts:
+                    self.submit(path, force, attempt, delay=self.retry_delay * 2**(attempt - 1))
+                else:
+                    _logger.exception(f'Failed to remove {path}, giving up')
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+_background_remover = _BackgroundRemover()
+
+def hash(path, hash_function=hashlib.sha512, executor=None, cache=None, block_size=2**20, progress=None):
     '''
     Hash file or directory.
 
@@ -197,7 +919,21 @@ def hash(path, hash_function=hashlib.sha512):
         File or directory to hash.
     hash_function : ~typing.Callable[[], hash object]
         Function which creates a hashlib hash object when called. Defaults to
-        ``hashlib.sha512``.
+        ``hashlib.sha512``. Of a directory, the contents of its files are
+        hashed with ``hashlib.sha512`` regardless; their digests are then
+        hashed with this function.
+    executor : concurrent.futures.Executor
+        If given, the files of a directory are hashed concurrently in this
+        executor. The result is the same as without.
+    cache : DigestCache
+        If given, the files of a directory whose stat signature is unchanged
+        since they were last hashed are not read again; their cached digest is
+        used instead.
+    block_size : int
+        Number of bytes to read from a file at a time.
+    progress : ~typing.Callable[[int], None]
+        If given, called with the number of files hashed since the last call.
+        If it raises, hashing stops and the exception is reraised.
 
     Returns
     -------
@@ -206,44 +942,934 @@ def hash(path, hash_function=hashlib.sha512):
         is ignored. The directory digest covers file/directory contents and
         their location relative to the directory being digested. The directory
         name itself is ignored.
+
+    See also
+    --------
+    hash_async : Hash without blocking the event loop
     '''
     hash_ = hash_function()
     if path.is_dir():
-        for directory, directories, files in os.walk(str(path), topdown=True):
-            # Note:
-            # - directory: path to current directory in walk relative to current working direcotry
-            # - directories/files: dir/file names
-
-            # Note: file names can contain nearly any character (even newlines).
-
-            # hash like (ignore the whitespace):
-            #
-            #   h(relative-dir-path)
-            #   h(dir_name)
-            #   h(dir_name2)
-            #   ,
-            #   h(file_name) h(file_content)
-            #   h(file_name2) h(file_content2)
-            #   ;
-            #   h(relative-dir-path2)
-            #   ...
-            hash_.update(hash_function(str(Path(directory).relative_to(path)).encode()).digest())
-            for name in sorted(directories):
-                hash_.update(hash_function(name.encode()).digest())
-            hash_.update(b',')
-            for name in sorted(files):
-                hash_.update(hash_function(name.encode()).digest())
-                hash_.update(hash(Path(directory) / name).digest())
-            hash_.update(b';')
+        # Digests of files still being hashed by the executor are folded in
+        # in order as they complete, keeping a bounded number in flight
+        pending = deque()
+        def fold(part, cache_key, is_file):
+            if not isinstance(part, bytes):
+                part = part.result()
+            hash_.update(part)
+            if cache_key is not None:
+                cache._put(*cache_key, part)
+            if is_file and progress is not None:
+                progress(1)
+        def update(part, cache_key=None, is_file=False):
+            pending.append((part, cache_key, is_file))
+            while pending and (
+                len(pending) > _max_pending_digests or isinstance(pending[0][0], bytes) or pending[0][0].done()
+            ):
+                fold(*pending.popleft())
+        # File contents are always hashed with sha512, whatever the
+        # hash_function, to keep the digest format of earlier versions
+        file_hash_function = hashlib.sha512
+        algorithm = 'sha512-64'
+
+        root = str(path.absolute())
+        try:
+            for directory, fd, directories, files in _walk(root):
+                # Note:
+                # - directory: absolute path to current directory in walk
+                # - directories/files: dir/file entries
+
+                # Note: file names can contain nearly any character (even newlines).
+
+                # hash like (ignore the whitespace):
+                #
+                #   h(relative-dir-path)
+                #   h(dir_name)
+                #   h(dir_name2)
+                #   ,
+                #   h(file_name) h(file_content)
+                #   h(file_name2) h(file_content2)
+                #   ;
+                #   h(relative-dir-path2)
+                #   ...
+                update(hash_function(str(Path(directory).relative_to(root)).encode()).digest())
+                for name in sorted(entry.name for entry in directories):
+                    update(hash_function(name.encode()).digest())
+                update(b',')
+                for entry in sorted(files, key=attrgetter('name')):
+                    update(hash_function(entry.name.encode()).digest())
+                    file = os.path.join(directory, entry.name)
+                    cache_key = None
+                    if cache is not None:
+                        cache_key = (file, algorithm, entry.stat())
+                        digest = cache._get(*cache_key)
+                        if digest is not None:
+                            update(digest, is_file=True)
+                            continue
+                    if executor is None:
+                        update(_file_digest(entry.name, file_hash_function, block_size, fd), cache_key, True)
+                    else:
+                        update(executor.submit(_file_digest, file, file_hash_function, block_size), cache_key, True)
+                update(b';')
+            while pending:
+                fold(*pending.popleft())
+        except BaseException:
+            _cancel(part for part, _, _ in pending if not isinstance(part, bytes))
+            raise
     else:
-        with path.open('rb') as f:
-            while True:
-                buffer = f.read(65536)
-                if not buffer:
-                    break
-                hash_.update(buffer)
+        _hash_file(path, hash_, block_size)
+        if progress is not None:
+            progress(1)
     return hash_
 
+async def hash_async(
+    path, hash_function=hashlib.sha512, executor=None, cache=None, block_size=2**20, max_workers=None, progress=None
+):
+    '''
+    Hash file or directory without blocking the event loop.
+
+    Like `hash`, but runs in the loop's default executor. When cancelled,
+    hashing stops at the next file hashed, before the cancellation completes.
+    Tasks submitted to ``executor`` which have not started yet are cancelled;
+    those already running may still finish afterwards.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        See `hash`.
+    hash_function : ~typing.Callable[[], hash object]
+        See `hash`.
+    executor : concurrent.futures.Executor
+        See `hash`.
+    cache : DigestCache
+        See `hash`.
+    block_size : int
+        See `hash`.
+    max_workers : int or None
+        If given and no ``executor`` is given, hash files concurrently in a
+        thread pool of this many threads.
+    progress : ~typing.Callable[[int], None]
+        If given, called on the event loop like the ``progress`` of `hash`.
+
+    Returns
+    -------
+    hash object
+        See `hash`.
+    '''
+    return await _run_async(
+        lambda executor, progress: _without_waits(hash, path, hash_function, executor, cache, block_size, progress),
+        executor, max_workers, progress
+    )
+
+#: Max number of tasks `hash` and `copy_tree` keep in flight when using an executor
+_max_pending_digests = 4096
+
+def _file_digest(path, hash_function, block_size, dir_fd=None):
+    'Get digest of file contents'
+    hash_ = hash_function()
+    _hash_file(path, hash_, block_size, dir_fd)
+    return hash_.digest()
+
+def _hash_file(path, hash_, block_size, dir_fd=None):
+    'Update hash object with file contents'
+    # Read into a single buffer, unbuffered, to avoid allocating and copying
+    # a bytes object per block
+    with open(os.open(path, os.O_RDONLY, dir_fd=dir_fd), 'rb', buffering=0) as f:
+        with suppress(AttributeError, OSError):  # Not available on all platforms
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        size = os.fstat(f.fileno()).st_size
+        buffer = memoryview(bytearray(min(block_size, size + 1)))
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            hash_.update(buffer[:read])
+
+class DigestCache:
+
+    '''
+    Persistent cache of file digests keyed by file stat signature.
+
+    Pass it to `hash` to avoid reading files again whose size, mtime, inode and
+    device are unchanged since they were last hashed. Changes to the cache are
+    saved on `close`.
+
+    Files modified in the last couple of seconds before being hashed are not
+    cached, as a later modification might not change their mtime.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        SQLite database file to store the cache in. It is created if missing.
+    max_entries : int or None
+        Max number of digests to keep. On `close`, the least recently used
+        digests exceeding this limit are evicted. `None` for no limit.
+    verify : bool
+        If True, ignore cached digests, hashing all files again, while still
+        updating the cache.
+
+    Examples
+    --------
+    >>> with DigestCache(Path('digests.sqlite')) as cache:
+    ...     digest = hash(Path('data'), cache=cache).hexdigest()
+    '''
+
+    def __init__(self, path, max_entries=None, verify=False):
+        self._max_entries = max_entries
+        self._verify = verify
+        self._now = time.time_ns()  # 'used' time of entries used in this session
+        self._used = []  # keys of cache hits
+        self._new = []  # entries to insert
+        # May be used from another thread than the one it was opened in, e.g.
+        # by hash_async, but not concurrently
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                device INTEGER NOT NULL,
+                digest BLOB NOT NULL,
+                used INTEGER NOT NULL,
+                PRIMARY KEY (path, algorithm)
+            )
+        ''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS digests_used ON digests (used)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get(self, path, algorithm, stat):
+        'Get digest of file if cached and its stat signature is unchanged, else None'
+        if self._verify:
+            return None
+        row = self._connection.execute(
+            'SELECT size, mtime_ns, inode, device, digest FROM digests WHERE path = ? AND algorithm = ?',
+            (path, algorithm)
+        ).fetchone()
+        if row is None or tuple(row[:4]) != _stat_signature(stat):
+            return None
+        self._used.append((path, algorithm))
+        if len(self._used) >= _max_buffered_cache_rows:
+            self._flush()
+        return row[4]
+
+    def _put(self, path, algorithm, stat, digest):
+        'Cache digest of file'
+        if self._now - stat.st_mtime_ns < _racy_mtime_ns:
+            return
+        self._new.append((path, algorithm, *_stat_signature(stat), digest))
+        if len(self._new) >= _max_buffered_cache_rows:
+            self._flush()
+
+    def _flush(self):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (entry + (self._now,) for entry in self._new)
+            )
+            self._connection.executemany(
+                'UPDATE digests SET used = ? WHERE path = ? AND algorithm = ?',
+                ((self._now,) + key for key in self._used)
+            )
+        self._new.clear()
+        self._used.clear()
+
+    def close(self):
+        'Save changes, evict digests exceeding ``max_entries`` and close'
+        self._flush()
+        if self._max_entries is not None:
+            with self._connection:
+                self._connection.execute(
+                    '''
+                    DELETE FROM digests WHERE rowid IN (
+                        SELECT rowid FROM digests ORDER BY used LIMIT max(0, (SELECT count(*) FROM digests) - ?)
+                    )
+                    ''',
+                    (self._max_entries,)
+                )
+        self._connection.close()
+
+#: Files modified less than this long before being hashed are not cached by DigestCache
+_racy_mtime_ns = 2 * 10**9
+
+#: Max number of new entries, or of cache hits, `DigestCache` buffers before
+#: writing them to the database
+_max_buffered_cache_rows = 1000
+
+def _stat_signature(stat):
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+def hash_tree(path, hash_function=hashlib.sha512, executor=None, block_size=2**20):
+    '''
+    Hash file or directory as a Merkle tree.
+
+    Unlike `hash`, this returns the digest of each file and directory in the
+    tree, so that one can tell which parts of 2 trees differ without hashing
+    them again.
+
+    Symlinks to directories are treated as empty directories, other symlinks
+    are followed.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        File or directory to hash.
+    hash_function : ~typing.Callable[[], hash object]
+        Function which creates a hashlib hash object when called. Defaults to
+        ``hashlib.sha512``.
+    executor : concurrent.futures.Executor
+        If given, files are hashed concurrently in this executor.
+    block_size : int
+        Number of bytes to read from a file at a time.
+
+    Returns
+    -------
+    DigestTree
+        Digest tree of ``path``. Like with `hash`, stat data and the name of
+        ``path`` itself are ignored. Its digests differ from those of `hash`.
+    '''
+    tree = _build_digest_tree(str(path), hash_function, executor, block_size)
+    tree._resolve(hash_function)
+    return tree
+
+def _build_digest_tree(path, hash_function, executor, block_size, is_dir=None):
+    'Build DigestTree, possibly with file digests still being calculated'
+    if is_dir is None:
+        is_dir = os.path.isdir(path)
+    if not is_dir:
+        if executor is None:
+            digest = _file_digest(Path(path), hash_function, block_size)
+        else:
+            digest = executor.submit(_file_digest, Path(path), hash_function, block_size)
+        return DigestTree(digest)
+    children = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                children[entry.name] = _build_digest_tree(entry.path, hash_function, executor, block_size, True)
+            elif entry.is_dir():
+                children[entry.name] = DigestTree(None, {})
+            else:
+                children[entry.name] = _build_digest_tree(entry.path, hash_function, executor, block_size, False)
+    return DigestTree(None, children)
+
+class DigestTree:
+
+    '''
+    Merkle tree of the digests of a file or directory and its descendants.
+
+    Get one with `hash_tree`. A directory's digest covers the names, types and
+    digests of its children.
+
+    Parameters
+    ----------
+    digest : bytes
+        Digest of the file or directory.
+    children : ~typing.Dict[str, DigestTree] or None
+        Children by name if a directory, `None` if a file.
+    '''
+
+    def __init__(self, digest, children=None):
+        self.digest = digest
+        self.children = children
+
+    @property
+    def is_dir(self):
+        'Whether the tree is of a directory'
+        return self.children is not None
+
+    def __eq__(self, other):
+        return isinstance(other, DigestTree) and self.digest == other.digest and self.is_dir == other.is_dir
+
+    def __repr__(self):
+        return f'DigestTree({self.digest.hex()}, {"dir" if self.is_dir else "file"})'
+
+    def hexdigest(self):
+        'Get digest as hex string'
+        return self.digest.hex()
+
+    def __getitem__(self, path):
+        '''
+        Get subtree.
+
+        Parameters
+        ----------
+        path : ~pathlib.PurePath
+            Path of the subtree, relative to this tree.
+
+        Returns
+        -------
+        DigestTree
+        '''
+        tree = self
+        for name in path.parts:
+            if not tree.is_dir or name not in tree.children:
+                raise KeyError(path)
+            tree = tree.children[name]
+        return tree
+
+    def _resolve(self, hash_function):
+        'Wait for file digests and calculate directory digests'
+        if self.is_dir:
+            for child in self.children.values():
+                child._resolve(hash_function)
+            self.digest = self._directory_digest(hash_function)
+        elif not isinstance(self.digest, bytes):
+            self.digest = self.digest.result()
+
+    def _directory_digest(self, hash_function):
+        # hash like (ignore the whitespace):
+        #
+        #   type h(name) digest
+        #   type2 h(name2) digest2
+        #   ...
+        #
+        # where type is d for a directory and f for a file, sorted by name
+        hash_ = hash_function()
+        for name in sorted(self.children):
+            child = self.children[name]
+            hash_.update(b'd' if child.is_dir else b'f')
+            hash_.update(hash_function(name.encode()).digest())
+            hash_.update(child.digest)
+        return hash_.digest()
+
+    def diff(self, other):
+        '''
+        Get paths which differ between trees.
+
+        Only subtrees whose digests differ are visited.
+
+        Parameters
+        ----------
+        other : DigestTree
+            Tree to compare to.
+
+        Yields
+        ------
+        ~pathlib.PurePath
+            Path, relative to the trees, of each file or directory which was
+            added, removed or changed. Of changed directories only the
+            differing descendants are yielded, not the directory itself.
+        '''
+        yield from self._diff(other, PurePath())
+
+    def _diff(self, other, path):
+        if self == other:
+            return
+        if not (self.is_dir and other.is_dir):
+            yield path
+            return
+        for name in sorted(self.children.keys() | other.children.keys()):
+            if name in self.children and name in other.children:
+                yield from self.children[name]._diff(other.children[name], path / name)
+            else:
+                yield path / name
+
+    def update(self, root, path, hash_function=hashlib.sha512, block_size=2**20):
+        '''
+        Hash a subtree again and update the digests of its ancestors.
+
+        Only the given subtree is read, the digests of its ancestors are
+        calculated from the digests of their children.
+
+        Parameters
+        ----------
+        root : ~pathlib.Path
+            File or directory this tree is of.
+        path : ~pathlib.PurePath
+            Path of the subtree to hash again, relative to ``root``. It may
+            have been added or removed since the tree was made, but its parent
+            must be in the tree.
+        hash_function : ~typing.Callable[[], hash object]
+            Hash function used to make the tree.
+        block_size : int
+            Number of bytes to read from a file at a time.
+        '''
+        if not path.parts:
+            tree = hash_tree(root, hash_function, block_size=block_size)
+            self.digest = tree.digest
+            self.children = tree.children
+            return
+        ancestors = [self]
+        for name in path.parent.parts:
+            ancestors.append(ancestors[-1].children[name])
+        children = ancestors[-1].children
+        subtree_path = root / path
+        if subtree_path.is_symlink() and subtree_path.is_dir():
+            subtree = DigestTree(None, {})
+            subtree._resolve(hash_function)
+            children[path.name] = subtree
+        elif subtree_path.exists():
+            children[path.name] = hash_tree(subtree_path, hash_function, block_size=block_size)
+        else:
+            children.pop(path.name, None)
+        for ancestor in reversed(ancestors):
+            ancestor.digest = ancestor._directory_digest(hash_function)
+
+    def save(self, path):
+        '''
+        Save tree to file.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            File to write to, as JSON.
+        '''
+        path.write_text(json.dumps(self._to_json()))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load tree saved with `save`.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            File to read.
+
+        Returns
+        -------
+        DigestTree
+        '''
+        return cls._from_json(json.loads(path.read_text()))
+
+    def _to_json(self):
+        if self.is_dir:
+            return [self.hexdigest(), {name: child._to_json() for name, child in self.children.items()}]
+        return self.hexdigest()
+
+    @classmethod
+    def _from_json(cls, json_):
+        if isinstance(json_, str):
+            return cls(bytes.fromhex(json_))
+        digest, children = json_
+        return cls(
+            bytes.fromhex(digest),
+            {name: cls._from_json(child) for name, child in children.items()}
+        )
+
+class DirSnapshot:
+
+    '''
+    Stat info of the descendants of a directory, to detect changes.
+
+    Get one with `take`. Per descendant, its path relative to the directory,
+    type, size, mtime and inode are stored in columns sorted by path.
+    Optionally the digests of regular files are stored as well.
+
+    Directories are compared by type only, changes to their children show up
+    as changes of the children.
+
+    Attributes
+    ----------
+    paths : ~typing.List[str]
+        Relative paths of the descendants, sorted.
+    types : bytes
+        Type of each descendant: ``d`` directory, ``f`` regular file, ``l``
+        symlink, ``o`` other.
+    sizes, mtimes, inodes : array.array
+        Size, ``st_mtime_ns`` and inode of each descendant. Size and mtime are 0
+        for directories.
+    digests : ~typing.List[bytes] or None
+        Digest of each regular file, `None` for other types. `None` if files
+        were not hashed.
+    algorithm : str or None
+        Name and digest size of the hash function which made the digests.
+    '''
+
+    _types = {S_IFDIR: b'd', S_IFREG: b'f', S_IFLNK: b'l'}
+
+    def __init__(self, paths, types, sizes, mtimes, inodes, digests=None, algorithm=None, time_ns=0):
+        self.paths = paths
+        self.types = types
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.inodes = inodes
+        self.digests = digests
+        self.algorithm = algorithm
+        self._time_ns = time_ns  # when the snapshot was taken
+        self._indices = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def take(cls, path, hash_function=None, previous=None, block_size=2**20, ignore=None):
+        '''
+        Take snapshot of directory.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            Directory to snapshot.
+        hash_function : ~typing.Callable[[], hash object] or None
+            If given, regular files are hashed with it.
+        previous : DirSnapshot or None
+            Earlier snapshot of the same directory. Files whose stat info is
+            unchanged since and which were hashed with the same hash function
+            are not read again, their previous digest is used instead.
+        block_size : int
+            Number of bytes to read from a file at a time.
+        ignore : ~typing.Callable[[str], bool] or None
+            If given, called with the relative path of each descendant.
+            Descendants for which it returns True are left out of the
+            snapshot, directories are not walked into.
+
+        Returns
+        -------
+        DirSnapshot
+        '''
+        time_ns = time.time_ns()
+        algorithm = None
+        if hash_function:
+            hash_ = hash_function()
+            algorithm = f'{hash_.name}-{hash_.digest_size}'
+        if previous is not None and (algorithm is None or previous.algorithm != algorithm):
+            previous = None
+        rows = []
+        root = str(path)
+        for directory, fd, directories, files in _walk(root):
+            prefix = os.path.relpath(directory, root)
+            prefix = '' if prefix == os.curdir else prefix + os.sep
+            if ignore is not None:
+                # Prune ignored directories from the walk
+                directories[:] = [entry for entry in directories if not ignore(prefix + entry.name)]
+                files = [entry for entry in files if not ignore(prefix + entry.name)]
+            for entry in chain(directories, files):
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                relative_path = prefix + entry.name
+                type_ = cls._types.get(S_IFMT(stat.st_mode), b'o')
+                if type_ == b'd':
+                    rows.append((relative_path, type_, 0, 0, stat.st_ino, None))
+                    continue
+                digest = None
+                if type_ == b'f' and algorithm:
+                    if previous is not None:
+                        digest = previous._reusable_digest(relative_path, stat)
+                    if digest is None:
+                        digest = _file_digest(entry.name, hash_function, block_size, dir_fd=fd)
+                rows.append((relative_path, type_, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest))
+        rows.sort()
+        paths, types, sizes, mtimes, inodes, digests = zip(*rows) if rows else ((),) * 6
+        return cls(
+            list(paths),
+            b''.join(types),
+            array('Q', sizes),
+            array('q', mtimes),
+            array('Q', inodes),
+            list(digests) if algorithm else None,
+            algorithm,
+            time_ns,
+        )
+
+    def _index(self, path):
+        if self._indices is None:
+            self._indices = {path: i for i, path in enumerate(self.paths)}
+        return self._indices.get(path)
+
+    def _reusable_digest(self, path, stat):
+        'Get digest of path if its stat info is unchanged, else None'
+        i = self._index(path)
+        if (
+            i is None
+            or self.types[i:i+1] != b'f'
+            or (self.sizes[i], self.mtimes[i], self.inodes[i]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            # The file may have changed after it was hashed without changing
+            # its mtime if it was modified right before
+            or self._time_ns - stat.st_mtime_ns < _racy_mtime_ns
+        ):
+            return None
+        return self.digests[i]
+
+    def diff(self, previous):
+        '''
+        Get changes since previous snapshot.
+
+        Entries are compared by type and, when both snapshots have their
+        digest, by digest. Otherwise by size, mtime and inode.
+
+        Parameters
+        ----------
+        previous : DirSnapshot
+            Earlier snapshot of the same directory.
+
+        Returns
+        -------
+        ~typing.Tuple[~typing.List[str], ~typing.List[str], ~typing.List[str]]
+            Relative paths of added, removed and modified descendants, sorted.
+        '''
+        added = []
+        removed = []
+        modified = []
+        compare_digests = self.digests is not None and previous.digests is not None and self.algorithm == previous.algorithm
+        i = j = 0
+        while i < len(self.paths) and j < len(previous.paths):
+            path = self.paths[i]
+            previous_path = previous.paths[j]
+            if path < previous_path:
+                added.append(path)
+                i += 1
+            elif path > previous_path:
+                removed.append(previous_path)
+                j += 1
+            else:
+                type_ = self.types[i]
+                if type_ != previous.types[j]:
+                    modified.append(path)
+                elif type_ == ord('f') and compare_digests:
+                    if self.digests[i] != previous.digests[j]:
+                        modified.append(path)
+                elif type_ != ord('d'):
+                    if (self.sizes[i], self.mtimes[i], self.inodes[i]) != (previous.sizes[j], previous.mtimes[j], previous.inodes[j]):
+                        modified.append(path)
+                i += 1
+                j += 1
+        added.extend(self.paths[i:])
+        removed.extend(previous.paths[j:])
+        return added, removed, modified
+
+    def save(self, path):
+        '''
+        Save snapshot to file.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            File to write to, as a pickle.
+        '''
+        columns = (self.paths, self.types, self.sizes, self.mtimes, self.inodes, self.digests, self.algorithm, self._time_ns)
+        with path.open('wb') as f:
+            pickle.dump(columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load snapshot saved with `save`.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            File to read. Only load trusted files, it is unpickled.
+
+        Returns
+        -------
+        DirSnapshot
+        '''
+        with path.open('rb') as f:
+            return cls(*pickle.load(f))
+
+def copy_tree(
+    src, dst, store=None, link='hardlink', hash_function=hashlib.sha512, executor=None, cache=None, manifest=None,
+    block_size=2**20
+):
+    '''
+    Copy directory tree, deduplicating files with identical contents.
+
+    Files are hashed and each set of files with the same digest is copied
+    once; the others are linked to or cloned from the copy. With a ``store``,
+    contents are copied into the store only if not already in it, so
+    contents shared across copies are not copied again.
+
+    Only directories, symlinks and regular files are copied. Modes are copied
+    of regular files only.
+    Unlike `hash`, which skips directories it cannot list, the `OSError` of
+    listing a directory in ``src`` is raised.
+
+    Parameters
+    ----------
+    src : ~pathlib.Path
+        Directory to copy.
+    dst : ~pathlib.Path
+        Path to copy to. Must not exist yet.
+    store : ~pathlib.Path or None
+        Directory of a content-addressed store: files named after the digest
+        of their contents. Files in the store are read-only and must not be
+        changed. Created if it does not exist.
+    link : str
+        How to create files from a copy of identical contents, one of:
+
+        'hardlink'
+            Hardlink. The files share their mode, with a ``store`` that is
+            read-only. Falls back to copying when hardlinking is not possible,
+            e.g. across file systems.
+        'reflink'
+            Copy, sharing data blocks with the copy where the file system
+            supports it, e.g. Btrfs and XFS. Falls back to copying.
+        'copy'
+            Copy.
+
+    hash_function : ~typing.Callable[[], hash object]
+        Function which creates a hashlib hash object to hash file contents.
+    executor : concurrent.futures.Executor
+        If given, hash and copy files concurrently in this
+        `~concurrent.futures.ThreadPoolExecutor`.
+    cache : DigestCache
+        If given, files in ``src`` whose stat signature is unchanged since
+        they were last hashed are not read to hash them.
+    manifest : ~pathlib.Path or None
+        If given, the returned manifest is written to this file as JSON, with
+        hex digests.
+    block_size : int
+        Number of bytes to read from a file at a time.
+
+    Returns
+    -------
+    ~typing.Dict[~pathlib.PurePath, bytes]
+        Manifest: digest of each regular file by its path relative to ``src``.
+    '''
+    if link not in ('hardlink', 'reflink', 'copy'):
+        raise ValueError(f'Invalid link: {link!r}')
+    hash_ = hash_function()
+    algorithm = f'{hash_.name}-{hash_.digest_size}'
+    dst.mkdir(parents=True)
+
+    # Create directories and symlinks, hash files. Digests still being hashed
+    # by the executor are resolved oldest first, keeping a bounded number in
+    # flight
+    files = []  # [(relative path, source, digest or future of it, cache key)]
+    pending = deque()  # indices in files of futures
+    def resolve(index):
+        relative_path, source, digest, cache_key = files[index]
+        files[index] = (relative_path, source, digest.result(), cache_key)
+    root = str(src.absolute())
+    try:
+        for directory, fd, directories, regular_files in _walk(root, onerror=_raise):
+            relative_directory = os.path.relpath(directory, root)
+            for entry in chain(directories, regular_files):
+                relative_path = os.path.normpath(os.path.join(relative_directory, entry.name))
+                target = str(dst / relative_path)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.name, dir_fd=fd), target)
+                elif entry.is_dir():
+                    os.mkdir(target)
+                elif entry.is_file():
+                    source = os.path.join(directory, entry.name)
+                    cache_key = None
+                    digest = None
+                    if cache is not None:
+                        cache_key = (source, algorithm, entry.stat())
+                        digest = cache._get(*cache_key)
+                    if digest is None:
+                        if executor is None:
+                            digest = _file_digest(entry.name, hash_function, block_size, fd)
+                        else:
+                            digest = executor.submit(_file_digest, source, hash_function, block_size)
+                            pending.append(len(files))
+                    files.append((relative_path, source, digest, cache_key))
+                    if len(pending) > _max_pending_digests:
+                        resolve(pending.popleft())
+        while pending:
+            resolve(pending.popleft())
+    except BaseException:
+        _cancel(files[index][2] for index in pending)
+        raise
+
+    # Copy each set of identical files once
+    copies = {}  # digest -> [(source, target)]
+    manifest_ = {}
+    for relative_path, source, digest, cache_key in files:
+        if cache_key is not None:
+            cache._put(*cache_key, digest)
+        manifest_[PurePath(relative_path)] = digest
+        copies.setdefault(digest, []).append((source, str(dst / relative_path)))
+    futures = deque()
+    for digest, copies_ in copies.items():
+        store_file = None
+        if store is not None:
+            hexdigest = digest.hex()
+            store_file = str(store / algorithm / hexdigest[:2] / hexdigest[2:])
+        if executor is None:
+            _copy_identical(copies_, store_file, link)
+        else:
+            futures.append(executor.submit(_copy_identical, copies_, store_file, link))
+            if len(futures) > _max_pending_digests:
+                futures.popleft().result()
+    for future in futures:
+        future.result()
+
+    if manifest is not None:
+        manifest.write_text(json.dumps({
+            'algorithm': algorithm,
+            'files': {str(path): digest.hex() for path, digest in manifest_.items()},
+        }))
+    return manifest_
+
+def _copy_identical(copies, store_file, link):
+    '''
+    Copy files with identical contents.
+
+    Parameters
+    ----------
+    copies : ~typing.List[~typing.Tuple[str, str]]
+        Source and target of each file.
+    store_file : str or None
+        File in the store with their contents, if using a store.
+    link : str
+        See `copy_tree`.
+    '''
+    if store_file is None:
+        source, target = copies[0]
+        _copy_file(source, source, target, 'reflink' if link == 'reflink' else 'copy')
+        origin = target
+        copies = copies[1:]
+    else:
+        if not os.path.exists(store_file):
+            _add_to_store(copies[0][0], store_file)
+        origin = store_file
+    for source, target in copies:
+        _copy_file(origin, source, target, link)
+
+def _copy_file(origin, source, target, link):
+    'Create target with the contents of origin, and if copied the mode of source'
+    if link == 'hardlink':
+        try:
+            os.link(origin, target)
+            return
+        except OSError as ex:
+            # Fall back to copying across file systems or at the max number of links
+            if ex.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+    if link == 'reflink':
+        _reflink(origin, target)
+    else:
+        shutil.copyfile(origin, target)
+    shutil.copymode(source, target)
+
+def _add_to_store(source, store_file):
+    'Copy file into content-addressed store, atomically'
+    directory = os.path.dirname(store_file)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary_file = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    os.close(fd)
+    try:
+        _reflink(source, temporary_file)
+        os.chmod(temporary_file, 0o444)
+        os.replace(temporary_file, store_file)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(temporary_file)
+        raise
+
+#: FICLONE ioctl request number, from linux/fs.h
+_FICLONE = 0x40049409
+
+def _reflink(source, target):
+    'Copy file, sharing data blocks with the source if the file system supports it'
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        if fcntl is not None:
+            with suppress(OSError):  # Not supported by the file system, or across file systems
+                fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+                return
+        shutil.copyfileobj(source_file, target_file)
+
 def is_descendant(descendant, ancestor):
     '''
     Get whether path is descendant of other path.
@@ -316,6 +1942,84 @@ def is_descendant_or_self(descendant, ancestor):
     return _is_descendant(descendant, ancestor, or_self=True)
 
 def _is_descendant(descendant, ancestor, or_self):
-    ancestor = ancestor.resolve()
-    descendant = descendant.resolve()
-    return ancestor in descendant.parents or (or_self and ancestor == descendant)
+    ancestor = ancestor.resolve().parts
+    descendant = descendant.resolve().parts
+    return descendant[:len(ancestor)] == ancestor and (or_self or len(descendant) > len(ancestor))
+
+class AncestorIndex:
+
+    '''
+    Index of paths to check whether other paths are their descendants.
+
+    Like calling `is_descendant` for each ancestor, but ancestors are resolved
+    only once and indexed in a trie of their parts, so that a query takes
+    O(depth of the path) regardless of the number of ancestors. Resolved paths
+    are cached as well.
+
+    Parameters
+    ----------
+    ancestors : ~typing.Iterable[~pathlib.Path]
+        Supposed ancestors.
+    cache_size : int or None
+        Max number of resolved paths to cache, `None` for no limit. The cache
+        does not notice later changes to symlinks or, for relative paths, to
+        the current working directory.
+
+    Examples
+    --------
+    >>> index = AncestorIndex([Path('a'), Path('b/c')])
+    >>> index.is_descendant(Path('b/c/d'))
+    True
+    >>> index.is_descendant(Path('b'))
+    False
+    '''
+
+    def __init__(self, ancestors, cache_size=4096):
+        self._resolve = lru_cache(maxsize=cache_size)(Path.resolve)
+        self._trie = {}  # part -> subtrie, None -> True if an ancestor ends here
+        for ancestor in ancestors:
+            trie = self._trie
+            for part in self._resolve(ancestor).parts:
+                trie = trie.setdefault(part, {})
+            trie[None] = True
+
+    def is_descendant(self, path):
+        '''
+        Get whether path is a descendant of any of the ancestors.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            Supposed descendant.
+
+        Returns
+        -------
+        bool
+        '''
+        return self._lookup(path, or_self=False)
+
+    def is_descendant_or_self(self, path):
+        '''
+        Get whether path is a descendant of or equivalent to any of the
+        ancestors.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            Supposed descendant.
+
+        Returns
+        -------
+        bool
+        '''
+        return self._lookup(path, or_self=True)
+
+    def _lookup(self, path, or_self):
+        trie = self._trie
+        for part in self._resolve(path).parts:
+            if None in trie:
+                return True
+            trie = trie.get(part)
+            if trie is None:
+                return False
+        return or_self and None in trie
@@ -16,10 +16,18 @@
 # along with pytil.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
+from collections import OrderedDict
+from functools import wraps
 from pathlib import Path
 from pytil import path as path_  # yay, 'resolving' circular dependencies
 import pytest
+import importlib
+import threading
+import tempfile
+import hashlib
+import json
+import time
 import os
 
 
@@ -39,9 +47,37 @@ def temp_dir_cwd(tmpdir):
 
     os.chdir(str(original_cwd))
 
+@pytest.fixture
+def temp_dir_cwd_tmpfs(tmp_path_factory):
+    '''
+    pytest fixture which sets current working directory to a temporary
+    directory on a tmpfs, if available.
+
+    Like `temp_dir_cwd`, but the directory is created in :file:`/dev/shm` if
+    writable, else in pytest's base temporary directory. It is removed in the
+    background on teardown, see `pytil.path.remove_in_background`, forced
+    i.e. with read-only contents made writable first.
+
+    The directory is named as a tombstone of the test process, so that if the
+    process is killed before teardown, the directory is removed by the
+    tombstone sweep of a later test process.
+    '''
+    directory = _tmpfs if os.access(_tmpfs, os.W_OK) else tmp_path_factory.getbasetemp()
+    prefix = path_._own_tombstone_prefix() + 'pytil-test-'
+    path = Path(tempfile.mkdtemp(prefix=prefix, dir=str(directory)))
+    original_cwd = Path.cwd()
+    os.chdir(str(path))
+    try:
+        yield path
+    finally:
+        os.chdir(str(original_cwd))
+        path_.remove_in_background(path, force=True)
+
+_tmpfs = '/dev/shm'
+
 # Used by cedalion
 @contextmanager
-def assert_dir_unchanged(path, ignore=()):
+def assert_dir_unchanged(path, ignore=(), recursive=False, contents=False):
     '''
     Assert dir unchanged after code block.
 
@@ -51,6 +87,14 @@ def assert_dir_unchanged(path, ignore=()):
         Dir to assert for changes.
     ignore : ~typing.Collection[~pathlib.Path]
         Paths to ignore in comparison.
+    recursive : bool
+        If False, only compare the names of the children of the dir. If True,
+        compare all descendants, including the stat info of files (size, mtime,
+        inode), see `pytil.path.DirSnapshot`.
+    contents : bool
+        If True, compare the contents of files instead of their stat info. Only
+        files whose stat info changed are hashed again. Requires
+        ``recursive``.
 
     Examples
     --------
@@ -60,16 +104,254 @@ def assert_dir_unchanged(path, ignore=()):
       File "<stdin>", line 1, in <module>
     AssertionError: ...
     '''
-    def contents():
-        children = set(path.iterdir())
-        ignored_children = {
-            child
-            for child in children
-            for path in ignore
-            if path_.is_descendant_or_self(child, path)
+    if contents and not recursive:
+        raise ValueError('contents requires recursive')
+    if recursive:
+        # Ignored paths relative to path, so that the snapshots prune them
+        root = path.resolve()
+        ignored = set()
+        for ignored_path in ignore:
+            with suppress(ValueError):  # Not inside path
+                ignored.add(str(ignored_path.resolve().relative_to(root)))
+        if os.curdir in ignored:
+            yield
+            return
+        hash_function = hashlib.sha256 if contents else None
+        expected = path_.DirSnapshot.take(path, hash_function, ignore=ignored.__contains__)
+        yield
+        actual = path_.DirSnapshot.take(path, hash_function, previous=expected, ignore=ignored.__contains__)
+        added, removed, modified = actual.diff(expected)
+        assert not (added or removed or modified), f'\nAdded: {added}\nRemoved: {removed}\nModified: {modified}'
+        return
+    def contents_():
+        # A new index per call, as its cache of resolved paths does not notice
+        # symlinks changed by the code block
+        ignore_ = path_.AncestorIndex(ignore)
+        return {
+            str(child)
+            for child in path.iterdir()
+            if not ignore_.is_descendant_or_self(child)
         }
-        return set(map(str, children - ignored_children))
-    expected = contents()
+    expected = contents_()
     yield
-    actual = contents()
+    actual = contents_()
     assert actual == expected, f'\nActual: {actual}\nExpected: {expected}'
+
+@pytest.fixture(scope='session')
+def golden_cache():
+    '''
+    pytest fixture with a `GoldenCache` shared by all tests of the session.
+    '''
+    return GoldenCache()
+
+class GoldenCache:
+
+    '''
+    Cache of parsed golden files, i.e. expected outputs, to compare to.
+
+    Parsed files are cached by path and reparsed when their mtime changes.
+    The objects returned are shared between callers, so they must not be
+    modified.
+
+    Requires the dependencies of the corresponding comparison helpers, e.g.
+    lxml for `xml`.
+
+    Parameters
+    ----------
+    maxsize : int
+        Max number of parsed files to keep, least recently used ones are
+        evicted first.
+
+    Examples
+    --------
+    >>> assert_xml_equals(actual_file, golden_cache.xml(expected_file))
+    '''
+
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()  # (kind, absolute path) -> (mtime_ns, parsed file)
+
+    def xml(self, path):
+        '''
+        Get parsed XML file.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            XML file.
+
+        Returns
+        -------
+        lxml.etree._Element
+            Root element, to pass to `pytil.xml_compare.assert_xml_equals`.
+        '''
+        from lxml import etree
+        return self._get('xml', path, lambda: etree.parse(str(path)).getroot())
+
+    def workbook(self, path):
+        '''
+        Get loaded xlsx file.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            xlsx file.
+
+        Returns
+        -------
+        ~openpyxl.workbook.workbook.Workbook
+            Workbook, to pass to `pytil.xlsx_compare.assert_xlsx_equals`.
+        '''
+        from openpyxl import load_workbook
+        return self._get('workbook', path, lambda: load_workbook(str(path)))
+
+    def data_frame(self, path, read):
+        '''
+        Get data frame read from file.
+
+        The frame is cached as returned by ``read``, it is not normalized.
+        To compare normalized frames (e.g. with sorted index or converted
+        dtypes) without normalizing on each call, normalize in ``read``.
+
+        Parameters
+        ----------
+        path : ~pathlib.Path
+            File to read.
+        read : ~typing.Callable[[~pathlib.Path], ~pandas.DataFrame]
+            Function to read (and normalize) the file with, e.g.
+            `pandas.read_pickle`. Frames are cached per function, so pass the
+            same function object each time.
+
+        Returns
+        -------
+        ~pandas.DataFrame
+            Data frame, to pass to `pytil.data_frame.assert_df_equals`.
+        '''
+        return self._get(('data_frame', read), path, lambda: read(path))
+
+    def _get(self, kind, path, load):
+        key = (kind, path.absolute())
+        mtime = path.stat().st_mtime_ns
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, load())
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+        return entry[1]
+
+# pytest plugin, enable with ``pytest -p pytil.test``
+
+#: Helpers timed by ``--pytil-timings``, as (module, function name)
+_timed_helpers = (
+    ('pytil.data_frame', 'assert_df_equals'),
+    ('pytil.xml_compare', 'assert_xml_equals'),
+    ('pytil.xlsx_compare', 'assert_xlsx_equals'),
+    ('pytil.path', 'hash'),
+)
+
+def pytest_addoption(parser):
+    group = parser.getgroup('pytil')
+    group.addoption(
+        '--pytil-timings', action='store_true',
+        help='Report time spent in pytil assertion helpers and path.hash per test.'
+    )
+    group.addoption(
+        '--pytil-timings-top', type=int, default=10, metavar='N',
+        help='Number of (test, helper) pairs to report, slowest first. Default: 10.'
+    )
+    group.addoption(
+        '--pytil-timings-json', metavar='PATH',
+        help='Also write the timings of --pytil-timings to a JSON file.'
+    )
+
+def pytest_configure(config):
+    if config.getoption('pytil_timings', False):
+        config.pluginmanager.register(_HelperTimings(config), 'pytil-timings')
+
+class _HelperTimings:
+
+    '''
+    pytest plugin which times calls to `_timed_helpers`.
+
+    Helpers are replaced in their module by a timing wrapper while the plugin
+    is registered, so helpers imported with ``from module import helper``
+    before then, e.g. in a conftest, are not timed. Only the outermost call is
+    timed when helpers call each other.
+    '''
+
+    def __init__(self, config):
+        self._config = config
+        self._timings = {}  # (test node id, helper name) -> [calls, seconds]
+        self._test = None  # node id of the current test
+        self._local = threading.local()  # .depth: number of timed calls in progress
+        self._originals = []  # [(module, function name, original function)]
+        for module_name, name in _timed_helpers:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:  # Optional dependencies not installed
+                continue
+            original = getattr(module, name)
+            self._originals.append((module, name, original))
+            setattr(module, name, self._wrap(original, f'{module_name}.{name}'))
+
+    def _wrap(self, function, name):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            if depth:
+                return function(*args, **kwargs)
+            self._local.depth = 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self._local.depth = 0
+                timing = self._timings.setdefault((self._test, name), [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+        return timed
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item):
+        self._test = item.nodeid
+        yield
+        self._test = None
+
+    def pytest_terminal_summary(self, terminalreporter):
+        write_line = terminalreporter.write_line
+        terminalreporter.write_sep('=', 'pytil helper timings')
+        if not self._timings:
+            write_line('No helpers called')
+            return
+        for name, (calls, seconds) in sorted(self._per_helper().items(), key=lambda item: (-item[1][1], item[0])):
+            write_line(f'{seconds:9.3f}s {calls:7} calls  {name}')
+        top = self._config.getoption('pytil_timings_top')
+        write_line(f'\nSlowest {top} (test, helper) pairs:')
+        timings = sorted(self._timings.items(), key=lambda item: (-item[1][1], item[0]))[:top]
+        for (test, name), (calls, seconds) in timings:
+            write_line(f'{seconds:9.3f}s {calls:7} calls  {name}  {test or "(outside tests)"}')
+
+    def pytest_unconfigure(self):
+        for module, name, original in self._originals:
+            setattr(module, name, original)
+        path = self._config.getoption('pytil_timings_json')
+        if path:
+            tests = {}
+            for (test, name), (calls, seconds) in self._timings.items():
+                tests.setdefault(test, {})[name] = {'calls': calls, 'seconds': seconds}
+            helpers = {
+                name: {'calls': calls, 'seconds': seconds}
+                for name, (calls, seconds) in self._per_helper().items()
+            }
+            Path(path).write_text(json.dumps({'helpers': helpers, 'tests': tests}, indent=2))
+
+    def _per_helper(self):
+        helpers = {}
+        for (_, name), (calls, seconds) in self._timings.items():
+            timing = helpers.setdefault(name, [0, 0.0])
+            timing[0] += calls
+            timing[1] += seconds
+        return helpers
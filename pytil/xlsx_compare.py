@@ -17,12 +17,19 @@
 
 'xlsx file testing'
 
-from itertools import zip_longest
+from contextlib import contextmanager
+from itertools import zip_longest, islice
+from pathlib import Path
+from xml.etree.ElementTree import iterparse
+import posixpath
+import zipfile
 
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
+from openpyxl.cell.read_only import ReadOnlyCell
+from openpyxl.formatting.formatting import ConditionalFormatting, ConditionalFormattingList
 
 
-def assert_xlsx_equals(actual_file, expected_file):
+def assert_xlsx_equals(actual_file, expected_file, streaming=False, executor=None, max_differences=None):
     '''
     Assert whether xlsx files are equal.
 
@@ -43,19 +50,65 @@ def assert_xlsx_equals(actual_file, expected_file):
     - workbook/worksheet/cell protection
     - worksheet attributes other than name
     - defined names
+
+    By default both workbooks are loaded fully, which takes a lot of memory
+    for large sheets. With ``streaming``, cells are read one row at a time
+    instead; conditional formatting is read separately from the sheet XML.
+    The result is the same, except that cells outside the other sheet's range
+    are compared as blank cells instead of being reported as extra/missing.
+
+    Parameters
+    ----------
+    actual_file : ~pathlib.Path or ~openpyxl.workbook.workbook.Workbook
+        Actual xlsx file, or workbook loaded with ``read_only=False``.
+    expected_file : ~pathlib.Path or ~openpyxl.workbook.workbook.Workbook
+        Expected xlsx file, or workbook loaded with ``read_only=False``, e.g.
+        from `pytil.test.GoldenCache.workbook`.
+    streaming : bool
+        Whether to stream the cells of the workbooks instead of loading them
+        fully. Requires files, not workbooks.
+    executor : concurrent.futures.Executor
+        If given, compare sheets concurrently in this
+        `~concurrent.futures.ProcessPoolExecutor`, each task streaming a
+        single sheet of each file. Implies ``streaming``. Differences are
+        reported in sheet order all the same.
+    max_differences : int or None
+        If given, stop comparing after finding this many differences. Must be
+        at least 1.
     '''
-    def list_differences():
+    def list_differences(actual_wb, expected_wb):
+        assert actual_wb.sheetnames == expected_wb.sheetnames
         for actual_sheet, expected_sheet in zip(actual_wb, expected_wb):
-            for difference in _compare_sheet(actual_sheet, expected_sheet):
+            if streaming:
+                differences = _compare_sheet_streaming(actual_file, actual_sheet, expected_file, expected_sheet)
+            else:
+                differences = _compare_sheet(actual_sheet, expected_sheet)
+            for difference in differences:
                 yield f'{actual_sheet.title}: {difference}'
 
-    # Not loading read-only because it doesn't load conditional formatting
-    actual_wb = load_workbook(str(actual_file))
-    expected_wb = load_workbook(str(expected_file))
-    assert actual_wb.sheetnames == expected_wb.sheetnames
-    differences = '\n\n'.join(list_differences())
+    if max_differences is not None and max_differences < 1:
+        raise ValueError(f'max_differences must be at least 1, got {max_differences!r}')
+    streaming = streaming or executor is not None
+    if streaming and (isinstance(actual_file, Workbook) or isinstance(expected_file, Workbook)):
+        raise ValueError('streaming requires files, not workbooks')
+    if executor is not None:
+        differences = _compare_sheets_concurrently(actual_file, expected_file, executor, max_differences)
+    elif streaming:
+        with _load_read_only_workbook(actual_file) as actual_wb, _load_read_only_workbook(expected_file) as expected_wb:
+            differences = list(islice(list_differences(actual_wb, expected_wb), max_differences))
+    else:
+        actual_wb = _load_workbook(actual_file)
+        expected_wb = _load_workbook(expected_file)
+        differences = islice(list_differences(actual_wb, expected_wb), max_differences)
+    differences = '\n\n'.join(differences)
     assert not differences, differences
 
+def _load_workbook(file):
+    if isinstance(file, Workbook):
+        return file
+    # Not loading read-only because it doesn't load conditional formatting
+    return load_workbook(str(file))
+
 def _compare_sheet(actual_sheet, expected_sheet):
     for actual_row, expected_row in zip_longest(actual_sheet.rows, expected_sheet.rows):
         for actual_cell, expected_cell in zip_longest(actual_row, expected_row):
@@ -67,11 +120,13 @@ def _compare_sheet(actual_sheet, expected_sheet):
             for difference in _compare_cell(actual_cell, expected_cell):
                 yield f'Cell {actual_name}: {difference}'
 
-    pairs = zip_longest(
+    yield from _compare_conditional_formattings(
         actual_sheet.conditional_formatting,
         expected_sheet.conditional_formatting
     )
-    for actual_cf, expected_cf in pairs:
+
+def _compare_conditional_formattings(actual_cfs, expected_cfs):
+    for actual_cf, expected_cf in zip_longest(actual_cfs, expected_cfs):
         if actual_cf.sqref != expected_cf.sqref:
             yield (
                 f'Extra/missing conditional formatting: '
@@ -81,6 +136,168 @@ def _compare_sheet(actual_sheet, expected_sheet):
         for difference in _compare_conditional_formatting(actual_cf, expected_cf):
             yield f'Conditional formatting {actual_cf.sqref}: {difference}'
 
+@contextmanager
+def _load_read_only_workbook(file):
+    workbook = load_workbook(str(file), read_only=True)
+    try:
+        yield workbook
+    finally:
+        workbook.close()
+
+def _compare_sheet_streaming(actual_file, actual_sheet, expected_file, expected_sheet):
+    'Compare sheets of read-only workbooks'
+    # Merge join the non-empty cells of both sheets on their coordinate
+    border_differences = {}  # (actual border id, expected border id) -> differences
+    actual_cells = _iter_cells(actual_sheet)
+    expected_cells = _iter_cells(expected_sheet)
+    actual = next(actual_cells, None)
+    expected = next(expected_cells, None)
+    while actual is not None or expected is not None:
+        actual_coordinate = (actual.row, actual.column) if actual is not None else None
+        expected_coordinate = (expected.row, expected.column) if expected is not None else None
+        if expected is None or (actual is not None and actual_coordinate < expected_coordinate):
+            actual_cell = actual
+            expected_cell = ReadOnlyCell(expected_sheet, actual.row, actual.column, None)
+            actual = next(actual_cells, None)
+        elif actual is None or expected_coordinate < actual_coordinate:
+            actual_cell = ReadOnlyCell(actual_sheet, expected.row, expected.column, None)
+            expected_cell = expected
+            expected = next(expected_cells, None)
+        else:
+            actual_cell = actual
+            expected_cell = expected
+            actual = next(actual_cells, None)
+            expected = next(expected_cells, None)
+        differences = _compare_cell_streaming(actual_cell, expected_cell, border_differences)
+        for difference in differences:
+            yield f'Cell {_cell_name(actual_cell)}: {difference}'
+
+    yield from _compare_conditional_formattings(
+        _read_conditional_formatting(actual_file, actual_sheet.title),
+        _read_conditional_formatting(expected_file, expected_sheet.title),
+    )
+
+def _compare_sheets_concurrently(actual_file, expected_file, executor, max_differences):
+    'List differences between sheets, comparing each sheet in a separate task'
+    with _load_read_only_workbook(actual_file) as actual_wb, _load_read_only_workbook(expected_file) as expected_wb:
+        assert actual_wb.sheetnames == expected_wb.sheetnames
+        titles = actual_wb.sheetnames
+
+    # Workers may have a different working directory
+    actual_file = Path(actual_file).absolute()
+    expected_file = Path(expected_file).absolute()
+    futures = [
+        executor.submit(_compare_sheet_by_title, actual_file, expected_file, title, max_differences)
+        for title in titles
+    ]
+    differences = []
+    try:
+        for future in futures:
+            differences.extend(future.result())
+            if max_differences is not None and len(differences) >= max_differences:
+                return differences[:max_differences]
+        return differences
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _compare_sheet_by_title(actual_file, expected_file, title, max_differences):
+    'List differences between the sheets with the given title, streaming them'
+    with _load_read_only_workbook(actual_file) as actual_wb, _load_read_only_workbook(expected_file) as expected_wb:
+        differences = _compare_sheet_streaming(actual_file, actual_wb[title], expected_file, expected_wb[title])
+        return [f'{title}: {difference}' for difference in islice(differences, max_differences)]
+
+def _iter_cells(sheet):
+    'Iterate over the non-empty cells of a read-only sheet, row by row'
+    # Do not trust the dimensions in the file, they may be missing or wrong
+    sheet.reset_dimensions()
+    for row in sheet.iter_rows():
+        for cell in row:
+            if isinstance(cell, ReadOnlyCell):
+                yield cell
+
+def _compare_cell_streaming(actual, expected, border_differences):
+    'Like _compare_cell, but reuse the differences of previously compared border pairs'
+    yield from _compare_attr(actual, expected, 'value')
+    key = (actual.style_array.borderId, expected.style_array.borderId)
+    differences = border_differences.get(key)
+    if differences is None:
+        differences = [
+            f'border: {difference}'
+            for difference in _compare_border(actual.border, expected.border)
+        ]
+        border_differences[key] = differences
+    yield from differences
+
+_main_namespace = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_relationships_namespace = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+_relationship_id = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+_office_document_type = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+def _read_conditional_formatting(file, title):
+    '''
+    Read conditional formatting of sheet from xlsx file, like ``load_workbook``
+    does but without loading the cells.
+
+    Returns
+    -------
+    openpyxl.formatting.formatting.ConditionalFormattingList
+    '''
+    conditional_formatting = ConditionalFormattingList()
+    with zipfile.ZipFile(str(file)) as archive:
+        with archive.open(_sheet_path(archive, title)) as sheet:
+            for _, element in iterparse(sheet):
+                if element.tag == _main_namespace + 'conditionalFormatting':
+                    cf = ConditionalFormatting.from_tree(element)
+                    for rule in cf.rules:
+                        conditional_formatting[cf] = rule
+                    element.clear()
+                elif element.tag == _main_namespace + 'row':
+                    element.clear()
+    return conditional_formatting
+
+def _sheet_path(archive, title):
+    'Get path of sheet XML in xlsx archive'
+    workbook_path = next(
+        target
+        for type_, target in _relationships(archive, '').values()
+        if type_ == _office_document_type
+    )
+    relationships = _relationships(archive, workbook_path)
+    with archive.open(workbook_path) as workbook:
+        for _, element in iterparse(workbook):
+            if element.tag == _main_namespace + 'sheet' and element.get('name') == title:
+                return relationships[element.get(_relationship_id)][1]
+    raise KeyError(title)
+
+def _relationships(archive, part):
+    '''
+    Get relationships of a part of an xlsx archive.
+
+    Parameters
+    ----------
+    part : str
+        Path of the part, '' for the package.
+
+    Returns
+    -------
+    ~typing.Dict[str, ~typing.Tuple[str, str]]
+        Type and target path of each relationship by id.
+    '''
+    directory, name = posixpath.split(part)
+    relationships = {}
+    with archive.open(posixpath.join(directory, '_rels', name + '.rels')) as file:
+        for _, element in iterparse(file):
+            if element.tag != _relationships_namespace + 'Relationship':
+                continue
+            target = element.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(directory, target))
+            relationships[element.get('Id')] = (element.get('Type'), target)
+    return relationships
+
 def _cell_name(cell):
     return f'{cell.column}{cell.row}'
 
@@ -125,6 +342,10 @@ def _compare_border(actual, expected):
             yield f'{side}: {difference}'
 
 def _compare_side(actual, expected):
+    if (actual is None) != (expected is None):
+        yield f'{actual}\n!=\n{expected}'
+    if actual is None or expected is None:
+        return
     yield from _compare_attr(actual, expected, 'style')
     for difference in _compare_color(actual.color, expected.color):
         yield f'color: {difference}'
@@ -30,29 +30,34 @@ def assert_xml_equals(actual, expected):
 
     Parameters
     ----------
-    actual : ~typing.BinaryIO or ~pathlib.Path or str
-        Actual XML, as file object or Path to XML file, or XML contents as
-        string.
-    expected : ~typing.BinaryIO or ~pathlib.Path or str
-        Expected XML, as file object or Path to XML file, or XML contents as
-        string.
+    actual : ~typing.BinaryIO or ~pathlib.Path or str or lxml.etree._Element
+        Actual XML, as file object or Path to XML file, XML contents as
+        string, or parsed element.
+    expected : ~typing.BinaryIO or ~pathlib.Path or str or lxml.etree._Element
+        Expected XML, as file object or Path to XML file, XML contents as
+        string, or parsed element, e.g. from `pytil.test.GoldenCache.xml`.
     '''
     # Note: if this ever breaks, there is a way to write out XML to file
     # canonicalised. StringIO may help in not having to use any temp files
     # http://lxml.de/api/lxml.etree._ElementTree-class.html#write_c14n
     def tree(xml):
+        if etree.iselement(xml):
+            return xml
         if isinstance(xml, str):
-            xml = etree.fromstring(str(xml))
-        else:
-            if isinstance(xml, Path):
-                xml = str(xml)
-            xml = etree.parse(xml)
-        return xml.getroot()
+            return etree.fromstring(xml)
+        if isinstance(xml, Path):
+            xml = str(xml)
+        return etree.parse(xml).getroot()
+    def describe(xml):
+        # Of an element, its file if it was parsed from one
+        if etree.iselement(xml):
+            return xml.getroottree().docinfo.URL or etree.tostring(xml, encoding='unicode')
+        return xml
     def raise_assert(msg):
         assert False, (
             f'XMLs differ\n'
-            f'Actual XML: {actual}\n'
-            f'Expected XML: {expected}\n'
+            f'Actual XML: {describe(actual)}\n'
+            f'Expected XML: {describe(expected)}\n'
             f'Difference: {msg}'
         )
     xml_compare(tree(actual), tree(expected), reporter=raise_assert)
@@ -19,7 +19,7 @@ import signal
 
 # import fixtures
 # pylint: disable=unused-import
-from pytil.test import temp_dir_cwd
+from pytil.test import temp_dir_cwd, temp_dir_cwd_tmpfs, golden_cache
 
 
 # http://stackoverflow.com/a/30091579/1031434
@@ -17,7 +17,13 @@
 
 'Test pytil.observable'
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock
+import threading
+import asyncio
+import gc
+
+import numpy as np
 
 from pytil import observable
 import pytest
@@ -214,3 +220,725 @@ class TestSet:
             set_.remove(1)
         assert set_ == {1}
         listener.assert_not_called()
+
+class TestThreadSafeSet:
+
+    def test_listener(self):
+        set_ = observable.ThreadSafeSet({1})
+        listener = Mock()
+        set_.change_listeners.append(listener)
+        set_ ^= {1, 2}
+        assert set_ == {2}
+        listener.assert_called_once_with(added=frozenset({2}), removed=frozenset({1}))
+
+    def test_exception(self, caplog):
+        'When listener raises, log it, keep the change and call other listeners'
+        set_ = observable.ThreadSafeSet()
+        listener = Mock()
+        set_.change_listeners.extend((Mock(side_effect=Exception), listener))
+        set_.add(1)
+        assert set_ == {1}
+        listener.assert_called_once_with(added=frozenset({1}), removed=frozenset())
+        assert 'Change listener raised' in caplog.text
+
+    def test_threads(self):
+        'When changed from multiple threads, call listeners in order of changes'
+        set_ = observable.ThreadSafeSet()
+        replica = set()
+        inconsistencies = []
+        def on_changed(added, removed):
+            # Each change must apply to the state left by the previous one
+            if added & replica or not removed <= replica:
+                inconsistencies.append((added, removed))
+            replica.difference_update(removed)
+            replica.update(added)
+        set_.change_listeners.append(on_changed)
+        def write(offset):
+            for i in range(200):
+                set_.add(offset + i % 20)
+                set_.discard(offset + (i * 7) % 20)
+        threads = [threading.Thread(target=write, args=(i * 10,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not inconsistencies
+        assert replica == set_
+
+class TestAsyncListener:
+
+    def test_coroutine(self):
+        'Call coroutine listener on loop, in order of changes'
+        calls = []
+        async def on_changed(added, removed):
+            await asyncio.sleep(0)
+            calls.append((added, removed))
+        async def main():
+            set_ = observable.Set()
+            listener = observable.AsyncListener(on_changed)
+            set_.change_listeners.append(listener)
+            set_.add(1)
+            set_.add(2)
+            set_.discard(1)
+            assert not calls  # not called inside the mutating call
+            await listener.join()
+        asyncio.run(main())
+        assert calls == [
+            (frozenset({1}), frozenset()),
+            (frozenset({2}), frozenset()),
+            (frozenset(), frozenset({1})),
+        ]
+
+    def test_executor(self):
+        'Call regular listener in executor'
+        threads = []
+        def on_changed(added, removed):
+            threads.append(threading.current_thread())
+        async def main():
+            with ThreadPoolExecutor(1) as executor:
+                set_ = observable.Set()
+                listener = observable.AsyncListener(on_changed, executor=executor)
+                set_.change_listeners.append(listener)
+                set_.add(1)
+                await listener.join()
+        asyncio.run(main())
+        assert len(threads) == 1
+        assert threads[0] is not threading.current_thread()
+
+    def test_maxsize(self):
+        'When too many pending changes, raise and roll back'
+        async def main():
+            set_ = observable.Set()
+            listener = observable.AsyncListener(Mock(), maxsize=1)
+            set_.change_listeners.append(listener)
+            set_.add(1)
+            with pytest.raises(asyncio.QueueFull):
+                set_.add(2)
+            assert set_ == {1}
+            assert listener.pending == 1
+            await listener.join()
+            assert listener.pending == 0
+        asyncio.run(main())
+
+    def test_coalesce(self):
+        'When too many pending changes and coalesce, merge them'
+        on_changed = Mock()
+        async def main():
+            set_ = observable.Set({1, 2})
+            listener = observable.AsyncListener(on_changed, maxsize=1, coalesce=True)
+            set_.change_listeners.append(listener)
+            set_.add(3)
+            set_.discard(1)
+            set_.discard(3)
+            set_.add(1)
+            set_.add(4)
+            assert listener.pending == 1
+            await listener.join()
+        asyncio.run(main())
+        on_changed.assert_called_once_with(added=frozenset({4}), removed=frozenset())
+
+    def test_exception(self):
+        'When listener raises, pass it to the exception handler and carry on'
+        contexts = []
+        on_changed = Mock(side_effect=[Exception('oops'), None])
+        async def main():
+            asyncio.get_running_loop().set_exception_handler(
+                lambda loop, context: contexts.append(context)
+            )
+            set_ = observable.Set()
+            listener = observable.AsyncListener(on_changed)
+            set_.change_listeners.append(listener)
+            set_.add(1)
+            set_.add(2)
+            await listener.join()
+            assert set_ == {1, 2}
+        asyncio.run(main())
+        assert on_changed.call_count == 2
+        assert [str(context['exception']) for context in contexts] == ['oops']
+
+    def test_rollback(self):
+        'When a later listener rolls back a change, do not pass it'
+        on_changed = Mock()
+        async def main():
+            set_ = observable.Set()
+            listener = observable.AsyncListener(on_changed)
+            set_.change_listeners.append(listener)
+            set_.change_listeners.append(Mock(side_effect=[Exception(), None]))
+            with pytest.raises(Exception):
+                set_.add(1)
+            set_.add(2)
+            await listener.join()
+            assert set_ == {2}
+        asyncio.run(main())
+        on_changed.assert_called_once_with(added=frozenset({2}), removed=frozenset())
+
+    def test_rollback_coalesced(self):
+        'When a later listener rolls back a coalesced change, pass the net change'
+        on_changed = Mock()
+        async def main():
+            set_ = observable.Set()
+            listener = observable.AsyncListener(on_changed, maxsize=1, coalesce=True)
+            set_.change_listeners.append(listener)
+            set_.add(1)
+            set_.change_listeners.append(Mock(side_effect=Exception()))
+            with pytest.raises(Exception):
+                set_.add(2)
+            await listener.join()
+            assert set_ == {1}
+        asyncio.run(main())
+        on_changed.assert_called_once_with(added=frozenset({1}), removed=frozenset())
+
+    def test_cancel(self):
+        'When the drain is cancelled, the next change passes all pending changes'
+        calls = []
+        async def main():
+            called = asyncio.Event()
+            release = asyncio.Event()
+            async def on_changed(added, removed):
+                calls.append((added, removed))
+                called.set()
+                await release.wait()
+            set_ = observable.Set()
+            listener = observable.AsyncListener(on_changed)
+            set_.change_listeners.append(listener)
+            set_.add(1)
+            set_.add(2)
+            await called.wait()
+            listener._task.cancel()
+            await listener.join()
+            assert listener.pending == 1
+            release.set()
+            set_.add(3)
+            await listener.join()
+            assert listener.pending == 0
+        asyncio.run(main())
+        assert calls == [
+            (frozenset({1}), frozenset()),
+            (frozenset({2}), frozenset()),
+            (frozenset({3}), frozenset()),
+        ]
+
+class TestDict:
+
+    @pytest.fixture
+    def listener(self):
+        return Mock()
+
+    @pytest.fixture
+    def dict_(self, listener):
+        dict_ = observable.Dict({1: 'a', 2: 'b'})
+        dict_.change_listeners.append(listener)
+        return dict_
+
+    def test_array_values(self, listener):
+        'When values compare elementwise, consider them changed unless identical'
+        array = np.array([1, 2])
+        dict_ = observable.Dict(a=array)
+        dict_.change_listeners.append(listener)
+        dict_['a'] = array
+        listener.assert_not_called()
+        new = np.array([3, 4])
+        dict_['a'] = new
+        listener.assert_called_once_with(added={}, removed={}, changed={'a': (array, new)})
+
+    def test_construction(self):
+        assert observable.Dict() == {}
+        assert observable.Dict({1: 2}) == {1: 2}
+        assert observable.Dict([(1, 2)], x=3) == {1: 2, 'x': 3}
+
+    def test_setitem(self, dict_, listener):
+        # when adding new key, notify
+        dict_[3] = 'c'
+        assert dict_ == {1: 'a', 2: 'b', 3: 'c'}
+        listener.assert_called_once_with(added={3: 'c'}, removed={}, changed={})
+        listener.reset_mock()
+
+        # when changing value, notify
+        dict_[3] = 'd'
+        listener.assert_called_once_with(added={}, removed={}, changed={3: ('c', 'd')})
+        listener.reset_mock()
+
+        # when setting equal value, ignore
+        dict_[3] = 'd'
+        listener.assert_not_called()
+
+    def test_delitem(self, dict_, listener):
+        del dict_[1]
+        assert dict_ == {2: 'b'}
+        listener.assert_called_once_with(added={}, removed={1: 'a'}, changed={})
+        listener.reset_mock()
+
+        with pytest.raises(KeyError):
+            del dict_[1]
+        listener.assert_not_called()
+
+    def test_pop(self, dict_, listener):
+        assert dict_.pop(1) == 'a'
+        listener.assert_called_once_with(added={}, removed={1: 'a'}, changed={})
+        listener.reset_mock()
+
+        # when popping missing with default, ignore
+        assert dict_.pop(1, None) is None
+        listener.assert_not_called()
+
+    def test_popitem(self, dict_, listener):
+        assert dict_.popitem() == (2, 'b')
+        assert dict_ == {1: 'a'}
+        listener.assert_called_once_with(added={}, removed={2: 'b'}, changed={})
+
+    def test_setdefault(self, dict_, listener):
+        assert dict_.setdefault(1, 'x') == 'a'
+        listener.assert_not_called()
+
+        assert dict_.setdefault(3, 'c') == 'c'
+        listener.assert_called_once_with(added={3: 'c'}, removed={}, changed={})
+
+    def test_update(self, dict_, listener):
+        dict_.update({1: 'a', 2: 'x'}, y=1)
+        assert dict_ == {1: 'a', 2: 'x', 'y': 1}
+        listener.assert_called_once_with(added={'y': 1}, removed={}, changed={2: ('b', 'x')})
+        listener.reset_mock()
+
+        dict_ |= {3: 'c'}
+        listener.assert_called_once_with(added={3: 'c'}, removed={}, changed={})
+
+    def test_clear(self, dict_, listener):
+        dict_.clear()
+        assert dict_ == {}
+        listener.assert_called_once_with(added={}, removed={1: 'a', 2: 'b'}, changed={})
+
+    def test_rollback(self, dict_, listener):
+        'When a listener raises, rollback the change and do not notify others'
+        def on_changed(added, removed, changed):
+            raise Exception()
+        dict_.change_listeners.insert(0, on_changed)
+
+        with pytest.raises(Exception):
+            dict_.update({1: 'x', 3: 'c'})
+        assert dict_ == {1: 'a', 2: 'b'}
+
+        with pytest.raises(Exception):
+            dict_.clear()
+        assert dict_ == {1: 'a', 2: 'b'}
+
+        with pytest.raises(Exception):
+            dict_.popitem()
+        assert dict_ == {1: 'a', 2: 'b'}
+
+        # and keep the order of removed keys
+        with pytest.raises(Exception):
+            del dict_[1]
+        with pytest.raises(Exception):
+            dict_.pop(1)
+        with pytest.raises(Exception):
+            dict_.clear()
+        assert list(dict_.items()) == [(1, 'a'), (2, 'b')]
+        listener.assert_not_called()
+
+class TestList:
+
+    @pytest.fixture
+    def listener(self):
+        return Mock()
+
+    @pytest.fixture
+    def list_(self, listener):
+        list_ = observable.List([1, 2, 3])
+        list_.change_listeners.append(listener)
+        return list_
+
+    def test_array_values(self, listener):
+        'When values compare elementwise, consider them changed unless identical'
+        array = np.array([1, 2])
+        list_ = observable.List([array])
+        list_.change_listeners.append(listener)
+        list_[0] = array
+        listener.assert_not_called()
+        new = np.array([1, 2])
+        list_[0] = new
+        listener.assert_called_once_with(index=0, removed=(array,), added=(new,))
+
+    def test_construction(self):
+        assert observable.List() == []
+        assert observable.List((1, 2)) == [1, 2]
+
+    def test_setitem(self, list_, listener):
+        list_[-1] = 4
+        assert list_ == [1, 2, 4]
+        listener.assert_called_once_with(index=2, removed=(3,), added=(4,))
+        listener.reset_mock()
+
+        # when setting equal value, ignore
+        list_[0] = 1
+        listener.assert_not_called()
+
+        with pytest.raises(IndexError):
+            list_[3] = 1
+
+    def test_setitem_slice(self, list_, listener):
+        list_[1:2] = 'ab'
+        assert list_ == [1, 'a', 'b', 3]
+        listener.assert_called_once_with(index=1, removed=(2,), added=('a', 'b'))
+        listener.reset_mock()
+
+        list_[::2] = 'xy'
+        assert list_ == ['x', 'a', 'y', 3]
+        listener.assert_called_once_with(index=0, removed=(1, 'a', 'b'), added=('x', 'a', 'y'))
+
+        with pytest.raises(ValueError):
+            list_[::2] = 'x'
+
+    def test_delitem(self, list_, listener):
+        del list_[0]
+        assert list_ == [2, 3]
+        listener.assert_called_once_with(index=0, removed=(1,), added=())
+        listener.reset_mock()
+
+        list_.extend((4, 5))
+        listener.reset_mock()
+        del list_[::-2]
+        assert list_ == [2, 4]
+        listener.assert_called_once_with(index=1, removed=(3, 4, 5), added=(4,))
+
+    def test_append_extend(self, list_, listener):
+        list_.append(4)
+        listener.assert_called_once_with(index=3, removed=(), added=(4,))
+        listener.reset_mock()
+
+        list_ += (5, 6)
+        assert list_ == [1, 2, 3, 4, 5, 6]
+        listener.assert_called_once_with(index=4, removed=(), added=(5, 6))
+        listener.reset_mock()
+
+        # when extending with nothing, ignore
+        list_.extend(())
+        listener.assert_not_called()
+
+    def test_imul(self, list_, listener):
+        list_ *= 2
+        assert list_ == [1, 2, 3, 1, 2, 3]
+        listener.assert_called_once_with(index=3, removed=(), added=(1, 2, 3))
+        listener.reset_mock()
+
+        list_ *= 0
+        assert list_ == []
+        listener.assert_called_once_with(index=0, removed=(1, 2, 3, 1, 2, 3), added=())
+
+    def test_insert(self, list_, listener):
+        list_.insert(-1, 'x')
+        assert list_ == [1, 2, 'x', 3]
+        listener.assert_called_once_with(index=2, removed=(), added=('x',))
+        listener.reset_mock()
+
+        list_.insert(10, 'y')
+        listener.assert_called_once_with(index=4, removed=(), added=('y',))
+
+    def test_pop_remove(self, list_, listener):
+        assert list_.pop() == 3
+        listener.assert_called_once_with(index=2, removed=(3,), added=())
+        listener.reset_mock()
+
+        list_.remove(1)
+        assert list_ == [2]
+        listener.assert_called_once_with(index=0, removed=(1,), added=())
+        listener.reset_mock()
+
+        with pytest.raises(ValueError):
+            list_.remove(1)
+        with pytest.raises(IndexError):
+            list_.pop(5)
+        listener.assert_not_called()
+
+    def test_clear(self, list_, listener):
+        list_.clear()
+        assert list_ == []
+        listener.assert_called_once_with(index=0, removed=(1, 2, 3), added=())
+
+    def test_sort_reverse(self, list_, listener):
+        # when already sorted, ignore
+        list_.sort()
+        listener.assert_not_called()
+
+        list_.reverse()
+        assert list_ == [3, 2, 1]
+        listener.assert_called_once_with(index=0, removed=(1, 2, 3), added=(3, 2, 1))
+        listener.reset_mock()
+
+        list_.sort(key=lambda x: -x, reverse=True)
+        assert list_ == [1, 2, 3]
+
+    def test_rollback(self, list_, listener):
+        'When a listener raises, rollback the change and do not notify others'
+        def on_changed(index, removed, added):
+            raise Exception()
+        list_.change_listeners.insert(0, on_changed)
+
+        with pytest.raises(Exception):
+            list_[1:2] = 'abc'
+        assert list_ == [1, 2, 3]
+
+        with pytest.raises(Exception):
+            del list_[0]
+        assert list_ == [1, 2, 3]
+        listener.assert_not_called()
+
+class TestViews:
+
+    @pytest.fixture
+    def set_(self):
+        return observable.Set({1, 2, 3})
+
+    def test_filter(self, set_):
+        view = observable.filter(lambda x: x % 2, set_)
+        listener = Mock()
+        view.change_listeners.append(listener)
+        assert view == {1, 3}
+
+        set_ |= {4, 5}
+        assert view == {1, 3, 5}
+        listener.assert_called_once_with(added=frozenset({5}), removed=frozenset())
+        listener.reset_mock()
+
+        # when change does not affect view, ignore
+        set_.discard(2)
+        listener.assert_not_called()
+
+        set_.clear()
+        assert view == set()
+
+    def test_map(self, set_):
+        view = observable.map(lambda x: x // 2, set_)
+        listener = Mock()
+        view.change_listeners.append(listener)
+        assert view == {0, 1}
+
+        # when one of multiple items mapping to a value is removed, keep value
+        set_.discard(2)
+        assert view == {0, 1}
+        listener.assert_not_called()
+
+        set_.discard(3)
+        assert view == {0}
+        listener.assert_called_once_with(added=frozenset(), removed=frozenset({1}))
+        listener.reset_mock()
+
+        set_.symmetric_difference_update({1, 4})
+        assert view == {2}
+        listener.assert_called_once_with(added=frozenset({2}), removed=frozenset({0}))
+
+    def test_union(self, set_):
+        other = observable.Set({3, 4})
+        view = observable.union(set_, other)
+        assert view == {1, 2, 3, 4}
+
+        set_.discard(3)
+        assert view == {1, 2, 3, 4}
+        other.discard(3)
+        assert view == {1, 2, 4}
+        other.add(5)
+        assert view == {1, 2, 4, 5}
+
+    def test_intersection(self, set_):
+        other = observable.Set({3, 4})
+        view = observable.intersection(set_, other)
+        assert view == {3}
+
+        other.add(1)
+        assert view == {1, 3}
+        set_.discard(3)
+        assert view == {1}
+
+        with pytest.raises(ValueError):
+            observable.intersection()
+
+    def test_rollback(self, set_):
+        'When a view listener raises, roll back the change to the viewed set'
+        view = observable.map(lambda x: x // 2, set_)
+        def on_changed(added, removed):
+            raise Exception()
+        view.change_listeners.append(on_changed)
+
+        with pytest.raises(Exception):
+            set_.add(5)
+        assert set_ == {1, 2, 3}
+        assert view == {0, 1}
+
+        # and counts are left intact
+        view.change_listeners.remove(on_changed)
+        set_.discard(2)
+        assert view == {0, 1}
+
+    @pytest.mark.parametrize('make_view', (
+        lambda set_: observable.filter(lambda x: True, set_),
+        lambda set_: observable.map(lambda x: x // 2, set_),
+        lambda set_: observable.union(set_, observable.Set({3, 4})),
+        lambda set_: observable.intersection(set_, observable.Set({1, 3, 5})),
+    ))
+    def test_rollback_later_listener(self, set_, make_view):
+        'When a later listener of the viewed set raises, undo the change to the view'
+        view = make_view(set_)
+        expected = set(view)
+        view_listener = Mock()
+        view.change_listeners.append(view_listener)
+        def on_changed(added, removed):
+            raise Exception()
+        set_.change_listeners.append(on_changed)
+
+        with pytest.raises(Exception):
+            set_.add(5)
+        with pytest.raises(Exception):
+            set_.discard(3)
+        assert set_ == {1, 2, 3}
+        assert view == expected
+
+        # and view listeners are told to roll back too
+        assert len(view_listener.rollback.call_args_list) == len(view_listener.call_args_list)
+
+        # and counts are left intact
+        set_.change_listeners.remove(on_changed)
+        set_.discard(3)
+        set_.add(5)
+        assert view == make_view(set_)
+
+class TestJournal:
+
+    @pytest.fixture(params=(False, True), ids=('memory', 'file'))
+    def path(self, request, tmp_path):
+        if request.param:
+            return tmp_path / 'journal'
+        return None
+
+    def test_since(self, path):
+        set_ = observable.Set()
+        with observable.Journal(path) as journal:
+            set_.change_listeners.append(journal)
+            assert journal.seq == 0
+            set_.add(1)
+            set_ ^= {1, 2}
+            assert journal.seq == 2
+            assert list(journal.since(0)) == [
+                (1, frozenset({1}), frozenset()),
+                (2, frozenset({2}), frozenset({1})),
+            ]
+            assert list(journal.since(1)) == [(2, frozenset({2}), frozenset({1}))]
+            assert list(journal.since(2)) == []
+
+    def test_rollback(self, path):
+        'When other listener rolls back, do not record the change'
+        set_ = observable.Set()
+        set_.change_listeners.append(Mock(side_effect=Exception))
+        with observable.Journal(path) as journal:
+            set_.change_listeners.append(journal)
+            with pytest.raises(Exception):
+                set_.add(1)
+            assert journal.seq == 0
+
+    def test_replay(self, path):
+        set_ = observable.Set({1})
+        with observable.Journal(path) as journal:
+            set_.change_listeners.append(journal)
+            set_.add(2)
+            snapshot, seq = frozenset(set_), journal.seq
+            set_ -= {1}
+            set_ |= {3, 4}
+
+            restored = observable.Set(snapshot)
+            listener = Mock()
+            restored.change_listeners.append(listener)
+            assert journal.replay(restored, since=seq) == 3
+            assert restored == set_
+            assert listener.call_count == 2
+
+    def test_reopen(self, tmp_path):
+        'When reopening journal file, continue from its last change'
+        path = tmp_path / 'journal'
+        with observable.Journal(path) as journal:
+            journal(added=frozenset({1}), removed=frozenset())
+        with path.open('ab') as f:
+            f.write(b'incomplete')
+        with observable.Journal(path) as journal:
+            assert journal.seq == 1
+            journal(added=frozenset({2}), removed=frozenset())
+        with observable.Journal(path) as journal:
+            assert list(journal.since(0)) == [
+                (1, frozenset({1}), frozenset()),
+                (2, frozenset({2}), frozenset()),
+            ]
+
+class TestSubscribe:
+
+    @pytest.fixture(params=(observable.Set, observable.Dict, observable.List))
+    def observable_(self, request):
+        return request.param()
+
+    def change(self, observable_):
+        if isinstance(observable_, observable.Set):
+            observable_.add(1)
+        elif isinstance(observable_, observable.Dict):
+            observable_[1] = 1
+        else:
+            observable_.append(1)
+
+    def test_unsubscribe(self, observable_):
+        listener = Mock()
+        subscription = observable_.subscribe(listener)
+        self.change(observable_)
+        assert listener.call_count == 1
+        subscription.unsubscribe()
+        subscription.unsubscribe()  # when already unsubscribed, ignore
+        assert observable_.change_listeners == []
+
+        with observable_.subscribe(listener):
+            assert len(observable_.change_listeners) == 1
+        assert observable_.change_listeners == []
+
+    def test_priority(self, observable_):
+        calls = []
+        def listener(name):
+            return lambda **delta: calls.append(name)
+        observable_.change_listeners.append(listener('0a'))
+        observable_.subscribe(listener('-1'), priority=-1)
+        observable_.subscribe(listener('1a'), priority=1)
+        observable_.subscribe(listener('0b'))
+        observable_.subscribe(listener('1b'), priority=1)
+        self.change(observable_)
+        assert calls == ['1a', '1b', '0a', '0b', '-1']
+
+    def test_priority_append(self, observable_):
+        'When appending after a negative priority subscription, call it first'
+        calls = []
+        def listener(name):
+            return lambda **delta: calls.append(name)
+        observable_.subscribe(listener('-1'), priority=-1)
+        observable_.change_listeners.append(listener('0a'))
+        observable_.change_listeners.extend([listener('0b')])
+        self.change(observable_)
+        assert calls == ['0a', '0b', '-1']
+
+    def test_weak(self, observable_):
+        'When weakly subscribed listener is collected, remove it'
+        class Owner:
+            def __init__(self):
+                self.calls = 0
+            def on_changed(self, **delta):
+                self.calls += 1
+        owner = Owner()
+        observable_.subscribe(owner.on_changed, weak=True)
+        self.change(observable_)
+        assert owner.calls == 1
+        del owner
+        gc.collect()
+        assert observable_.change_listeners == []
+
+    def test_on_error(self, observable_, caplog):
+        'When on_error=log, log and keep the change'
+        listener = Mock()
+        observable_.subscribe(Mock(side_effect=Exception), priority=1, on_error='log')
+        observable_.subscribe(listener)
+        self.change(observable_)
+        assert len(observable_) == 1
+        listener.assert_called_once()
+        assert 'Change listener raised' in caplog.text
+
+        with pytest.raises(ValueError):
+            observable_.subscribe(listener, on_error='ignore')
@@ -17,16 +17,23 @@
 
 'Test pytil.path'
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from unittest.mock import Mock
 
 from pytil import path as path_
-from pathlib import Path
+from pathlib import Path, PurePath
 from contextlib import contextmanager
 from itertools import product
+import threading
 import tempfile
+import asyncio
 import hashlib
+import json
 import pytest
+import subprocess
 import errno
+import time
+import sys
 import os
 
 
@@ -80,6 +87,165 @@ class TestRemove:
         path_.remove(path, force=True)
         assert not path.exists()
 
+    def test_executor(self, path):
+        'When removing concurrently, remove the whole tree'
+        for i in range(3):
+            subdir = path / f'subdir{i}' / 'subsubdir'
+            subdir.mkdir(parents=True)
+            (path / f'emptydir{i}').mkdir()
+            for j in range(5):
+                (subdir / f'file{j}').touch()
+                (subdir.parent / f'file{j}').touch()
+        (path / 'link').symlink_to('subdir0')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            path_.remove(path, executor=executor)
+        assert not path.exists()
+
+    def test_executor_force(self, path):
+        path.mkdir()
+        (path / 'subdir').mkdir()
+        (path / 'subdir' / 'file').touch()
+        (path / 'subdir').chmod(0o000)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            path_.remove(path, force=True, executor=executor)
+        assert not path.exists()
+
+    @pytest.fixture
+    def open_file(self, monkeypatch):
+        '''
+        Simulate NFS removing a file which is still open: it is renamed to a
+        .nfs file instead, which goes away once the file is closed.
+
+        Returns a function which closes the file.
+        '''
+        unlink = os.unlink
+        def unlink_(path, *, dir_fd=None):
+            if os.path.basename(path) == 'open_file':
+                nfs_file = os.path.join(os.path.dirname(path), '.nfs0001')
+                os.rename(path, nfs_file, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            else:
+                unlink(path, dir_fd=dir_fd)
+        monkeypatch.setattr(os, 'unlink', unlink_)
+        def close():
+            for nfs_file in Path().glob('**/.nfs0001'):
+                unlink(str(nfs_file))
+        return close
+
+    @pytest.fixture
+    def nfs_tree(self, path, open_file):
+        '''
+        Tree with an open file, which is closed after a while.
+
+        Returns list to which is appended whether the rest of the tree had
+        been removed by the time it was closed.
+        '''
+        (path / 'a' / 'b').mkdir(parents=True)
+        (path / 'c').mkdir()
+        (path / 'c' / 'file').touch()
+        (path / 'a' / 'b' / 'open_file').touch()
+        rest_removed = []
+        def close():
+            rest_removed.append(not (path / 'c').exists())
+            open_file()
+        timer = threading.Timer(.3, close)
+        timer.start()
+        yield rest_removed
+        timer.cancel()
+
+    @pytest.mark.parametrize('concurrent', (False, True))
+    def test_nfs(self, path, nfs_tree, concurrent):
+        'When .nfs files linger, remove the rest first, then wait for them'
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            path_.remove(path, executor=executor if concurrent else None, nfs_poll=.05)
+        assert not path.exists()
+        assert nfs_tree == [True]
+
+    def test_nfs_timeout(self, path, nfs_tree):
+        with pytest.raises(TimeoutError):
+            path_.remove(path, nfs_poll=.05, nfs_timeout=.1)
+        assert (path / 'a' / 'b').exists()
+        assert not (path / 'c').exists()
+
+    def test_nfs_non_nfs(self, path, open_file):
+        'When a directory gets a regular child while waiting, raise'
+        (path / 'a').mkdir(parents=True)
+        (path / 'a' / 'open_file').touch()
+        threading.Timer(.1, (path / 'a' / 'file').touch).start()
+        with pytest.raises(OSError):
+            path_.remove(path, nfs_poll=.05, nfs_timeout=5)
+
+    def test_async(self, path, nfs_tree):
+        'When removing async, do not block the event loop'
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(.01)
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            await path_.remove_async(path, nfs_poll=.05)
+            ticker.cancel()
+        asyncio.run(main())
+        assert not path.exists()
+        assert ticks > 10
+
+    @pytest.mark.parametrize('max_workers', (None, 2))
+    def test_async_progress(self, path, max_workers):
+        'When removing async, report number of files removed'
+        for i in range(3):
+            (path / f'subdir{i}').mkdir(parents=True)
+            for j in range(4):
+                (path / f'subdir{i}' / f'file{j}').touch()
+        counts = []
+        asyncio.run(path_.remove_async(path, max_workers=max_workers, progress=counts.append))
+        assert not path.exists()
+        assert sum(counts) == 12
+
+    def test_async_cancel(self, path, monkeypatch):
+        'When cancelled, stop removing before cancellation completes'
+        for i in range(50):
+            (path / f'subdir{i}').mkdir(parents=True)
+            (path / f'subdir{i}' / 'file').touch()
+        unlink = os.unlink
+        def slow_unlink(*args, **kwargs):
+            time.sleep(.01)
+            unlink(*args, **kwargs)
+        monkeypatch.setattr(os, 'unlink', slow_unlink)
+        async def main():
+            task = asyncio.ensure_future(path_.remove_async(path, progress=lambda count: task.cancel()))
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return len(list(path.glob('*/file')))
+        remaining = asyncio.run(main())
+        assert 0 < remaining < 50
+        time.sleep(.05)
+        assert len(list(path.glob('*/file'))) == remaining
+
+    def test_async_cancel_executor(self, path, monkeypatch):
+        'When cancelled, cancel tasks in executor which have not started yet'
+        for i in range(50):
+            (path / f'subdir{i}').mkdir(parents=True)
+            (path / f'subdir{i}' / 'file').touch()
+        unlink = os.unlink
+        def slow_unlink(*args, **kwargs):
+            time.sleep(.01)
+            unlink(*args, **kwargs)
+        monkeypatch.setattr(os, 'unlink', slow_unlink)
+        async def main(executor):
+            task = asyncio.ensure_future(
+                path_.remove_async(path, executor=executor, progress=lambda count: task.cancel())
+            )
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            asyncio.run(main(executor))
+            time.sleep(.05)  # let the running task finish
+            remaining = len(list(path.glob('*/file')))
+            assert 0 < remaining < 50
+            time.sleep(.1)
+            assert len(list(path.glob('*/file'))) == remaining
+
     @pytest.mark.parametrize('symlink_to_file, symlink_in_dir', product(*[(False, True)]*2))
     def test_symlink(self, path, symlink_to_file, symlink_in_dir):
         'When path is symlink, remove symlink, but not its target'
@@ -224,6 +390,38 @@ class TestChmod:
         assert_file_mode(child_file, 0o640)
         assert_file_mode(grand_child, 0o640)
 
+    def test_recursive_executor(self, root, child_dir, child_file, grand_child, monkeypatch):
+        'When chmodding concurrently, same result'
+        monkeypatch.setattr(path_, '_chmod_batch_size', 1)
+        (child_dir / 'grand_child2').touch()
+        (root / 'link').symlink_to(child_file.name)
+        child_file.chmod(0o000)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            path_.chmod(root, 0o751, '+', recursive=True, executor=executor)
+        assert_file_mode(root, 0o755)
+        assert_file_mode(child_dir, 0o755)
+        assert_file_mode(child_file, 0o640)
+        assert_file_mode(grand_child, 0o644)
+        assert_file_mode(child_dir / 'grand_child2', 0o644)
+
+    def test_async(self, root, child_dir, child_file, grand_child):
+        counts = []
+        asyncio.run(path_.chmod_async(root, 0o700, recursive=True, max_workers=2, progress=counts.append))
+        assert_file_mode(child_dir, 0o700)
+        assert_file_mode(grand_child, 0o600)
+        assert sum(counts) == 4
+
+    def test_symlink(self, root, child_file):
+        'When path is symlink, ignore'
+        child_file.chmod(0o600)
+        link = root / 'link'
+        link.symlink_to(child_file.name)
+        path_.chmod(link, 0o777)
+        path_.chmod(root, 0o777, recursive=True)
+        assert_file_mode(child_file, 0o666)
+        path_.chmod(link, 0o111, '+', recursive=True)
+        assert_file_mode(child_file, 0o666)
+
     def test_dir_subtract_recursive(self, root, child_dir, child_file, grand_child):
         root.chmod(mode=0o777)
         child_dir.chmod(0o777)
@@ -249,6 +447,13 @@ def test_digest_file(path, contents):
     hash_.update(contents.encode())
     assert path_.hash(path).hexdigest() == hash_.hexdigest()
 
+@pytest.mark.parametrize('block_size', (1, 3, 2**20))
+def test_digest_file_block_size(path, contents, block_size):
+    'When reading in blocks of any size, digest is the same'
+    path.write_text(contents)
+    expected = hashlib.sha512(contents.encode()).hexdigest()
+    assert path_.hash(path, block_size=block_size).hexdigest() == expected
+
 class TestDigestDirectory:
 
     @pytest.fixture
@@ -324,6 +529,32 @@ class TestDigestDirectory:
             # Restore cwd for next tests, this should actually be in a fixture
             os.chdir(original_cwd)
 
+    @pytest.mark.parametrize('executor_type', (ThreadPoolExecutor, ProcessPoolExecutor))
+    def test_executor(self, root, original, executor_type, monkeypatch):
+        'When hashing with executor, hash is the same'
+        monkeypatch.setattr(path_, '_max_pending_digests', 2)
+        with executor_type(max_workers=2) as executor:
+            current = path_.hash(root, executor=executor).hexdigest()
+        assert original == current
+
+    @pytest.mark.parametrize('max_workers', (None, 2))
+    def test_async(self, root, original, max_workers):
+        counts = []
+        current = asyncio.run(path_.hash_async(root, max_workers=max_workers, progress=counts.append))
+        assert original == current.hexdigest()
+        assert sum(counts) == 3
+
+    @pytest.mark.parametrize('executor', (False, True))
+    def test_hash_function(self, root, executor):
+        'When using another hash function, digest is the same as in earlier versions'
+        root.chmod(0o755)
+        if executor:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                digest = path_.hash(root, hashlib.md5, executor=executor).hexdigest()
+        else:
+            digest = path_.hash(root, hashlib.md5).hexdigest()
+        assert digest == '18821540e504c43968f6e9a87c4c3fb0'
+
     def test_file_dir_stat(self, root, original):
         'When file/dir stat() changes, hash unchanged'
         (root / 'emptydir').chmod(0o404)
@@ -331,6 +562,373 @@ class TestDigestDirectory:
         current = path_.hash(root).hexdigest()
         assert original == current
 
+class TestDigestCache:
+
+    @pytest.fixture
+    def root(self, contents):
+        Path('root/subdir').mkdir(parents=True)
+        Path('root/file1').write_text(contents)
+        Path('root/subdir/file2').write_text(contents * 2)
+        for file in ('root/file1', 'root/subdir/file2'):
+            os.utime(file, ns=(0, 0))  # old enough to cache
+        return Path('root')
+
+    @pytest.fixture
+    def digests(self, monkeypatch):
+        'Files whose digest was calculated'
+        files = []
+        original = path_._file_digest
+        def file_digest(path, hash_function, block_size, dir_fd=None):
+            files.append(os.path.basename(path))
+            return original(path, hash_function, block_size, dir_fd)
+        monkeypatch.setattr(path_, '_file_digest', file_digest)
+        return files
+
+    def test_flush_used(self, root, monkeypatch):
+        'When many hits are buffered, write them out'
+        monkeypatch.setattr(path_, '_max_buffered_cache_rows', 2)
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        with path_.DigestCache(Path('cache')) as cache:
+            for _ in range(3):
+                path_.hash(root, cache=cache)
+                assert len(cache._used) < 2
+
+    def test_cache(self, root, digests):
+        expected = path_.hash(root).hexdigest()
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            assert path_.hash(root, cache=cache).hexdigest() == expected
+        assert sorted(digests) == ['file1', 'file2']
+
+        # When unchanged, use cached digests, even after reopening
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            assert path_.hash(root, cache=cache).hexdigest() == expected
+        assert digests == []
+
+        # When file changed, only hash that file
+        (root / 'file1').write_text('changed')
+        expected = path_.hash(root).hexdigest()
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            assert path_.hash(root, cache=cache).hexdigest() == expected
+        assert digests == ['file1']
+
+    def test_hash_function(self, root, digests):
+        'When hash function differs, reuse file digests as files are always hashed with sha512'
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        expected = path_.hash(root, hashlib.md5).hexdigest()
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            assert path_.hash(root, hashlib.md5, cache=cache).hexdigest() == expected
+        assert digests == []
+
+    def test_verify(self, root, digests):
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        digests.clear()
+        with path_.DigestCache(Path('cache'), verify=True) as cache:
+            path_.hash(root, cache=cache)
+        assert len(digests) == 2
+
+    def test_max_entries(self, root, digests):
+        with path_.DigestCache(Path('cache'), max_entries=1) as cache:
+            path_.hash(root, cache=cache)
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        assert len(digests) == 1
+
+    def test_recently_modified(self, root, digests):
+        'When file was modified just now, do not cache it'
+        (root / 'file1').write_text('changed')
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        digests.clear()
+        with path_.DigestCache(Path('cache')) as cache:
+            path_.hash(root, cache=cache)
+        assert digests == ['file1']
+
+class TestHashTree:
+
+    @pytest.fixture
+    def root(self, contents):
+        Path('root/subdir/subsubdir').mkdir(parents=True)
+        Path('root/emptydir').mkdir()
+        Path('root/file').write_text(contents)
+        Path('root/subdir/subfile').write_text(contents * 2)
+        Path('root/subdir/subsubdir/subsubfile').write_text(contents * 3)
+        Path('root/link').symlink_to('subdir')
+        return Path('root')
+
+    @pytest.fixture
+    def original(self, root):
+        return path_.hash_tree(root)
+
+    def test_file(self, path, contents):
+        path.write_text(contents)
+        tree = path_.hash_tree(path)
+        assert not tree.is_dir
+        assert tree.hexdigest() == hashlib.sha512(contents.encode()).hexdigest()
+
+    def test_subtrees(self, root, original):
+        assert original[PurePath('subdir/subfile')] == path_.hash_tree(root / 'subdir/subfile')
+        assert original[PurePath('link')].children == {}
+        with pytest.raises(KeyError):
+            original[PurePath('file/child')]
+
+    def test_executor(self, root, original):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert path_.hash_tree(root, executor=executor) == original
+
+    def test_no_root_name(self, root, original):
+        'When root directory renamed, digest unchanged'
+        root.rename('notroot')
+        assert path_.hash_tree(Path('notroot')) == original
+
+    def test_diff(self, root, original):
+        assert list(original.diff(original)) == []
+
+        (root / 'subdir/subsubdir/subsubfile').write_text('changed')
+        (root / 'emptydir').rmdir()
+        (root / 'new').touch()
+        current = path_.hash_tree(root)
+        assert current != original
+        assert list(current.diff(original)) == [
+            PurePath('emptydir'), PurePath('new'), PurePath('subdir/subsubdir/subsubfile')
+        ]
+
+        # When type changes, yield path
+        (root / 'file').unlink()
+        (root / 'file').mkdir()
+        assert PurePath('file') in set(path_.hash_tree(root).diff(original))
+
+    def test_update(self, root, original):
+        'When updating subtree, digests equal those of a full rehash'
+        tree = path_.hash_tree(root)
+        (root / 'subdir/subsubdir/subsubfile').write_text('changed')
+        tree.update(root, PurePath('subdir/subsubdir/subsubfile'))
+        assert tree == path_.hash_tree(root)
+        assert tree[PurePath('subdir')] != original[PurePath('subdir')]
+        assert tree[PurePath('emptydir')] == original[PurePath('emptydir')]
+
+        (root / 'new').touch()
+        tree.update(root, PurePath('new'))
+        assert tree == path_.hash_tree(root)
+
+        tree.update(root, PurePath('link'))
+        assert tree == path_.hash_tree(root)
+
+        path_.remove(root / 'link')
+        path_.remove(root / 'subdir')
+        tree.update(root, PurePath('subdir'))
+        tree.update(root, PurePath('link'))
+        assert tree == path_.hash_tree(root)
+
+    def test_save_load(self, original):
+        original.save(Path('tree.json'))
+        loaded = path_.DigestTree.load(Path('tree.json'))
+        assert loaded == original
+        assert list(loaded.diff(original)) == []
+        assert loaded[PurePath('subdir/subfile')] == original[PurePath('subdir/subfile')]
+
+class TestDirSnapshot:
+
+    @pytest.fixture
+    def root(self, contents):
+        Path('root/subdir').mkdir(parents=True)
+        Path('root/file').write_text(contents)
+        Path('root/subdir/subfile').write_text(contents * 2)
+        Path('root/link').symlink_to('subdir')
+        return Path('root')
+
+    def test_take(self, root):
+        snapshot = path_.DirSnapshot.take(root)
+        assert snapshot.paths == ['file', 'link', 'subdir', 'subdir/subfile']
+        assert snapshot.types == b'fldf'
+        assert snapshot.sizes[0] == (root / 'file').stat().st_size
+        assert snapshot.digests is None
+
+    def test_ignore(self, root):
+        'Leave out ignored paths, without walking into ignored directories'
+        ignored = []
+        def ignore(path):
+            ignored.append(path)
+            return path == 'subdir'
+        snapshot = path_.DirSnapshot.take(root, ignore=ignore)
+        assert snapshot.paths == ['file', 'link']
+        assert sorted(ignored) == ['file', 'link', 'subdir']
+
+    def test_diff(self, root, contents):
+        original = path_.DirSnapshot.take(root)
+        assert original.diff(original) == ([], [], [])
+        (root / 'file').unlink()
+        (root / 'subdir/new').write_text(contents)
+        (root / 'subdir/subfile').write_text(contents * 3)
+        (root / 'link').unlink()
+        (root / 'link').mkdir()
+        snapshot = path_.DirSnapshot.take(root)
+        assert snapshot.diff(original) == (['subdir/new'], ['file'], ['link', 'subdir/subfile'])
+
+    def test_diff_digests(self, root, contents):
+        'When hashed, touched files are unchanged'
+        original = path_.DirSnapshot.take(root, hashlib.sha256)
+        (root / 'file').write_text(contents)
+        os.utime(str(root / 'file'), ns=(0, 0))
+        snapshot = path_.DirSnapshot.take(root, hashlib.sha256)
+        assert snapshot.digests[0] == hashlib.sha256(contents.encode()).digest()
+        assert snapshot.diff(original) == ([], [], [])
+        assert path_.DirSnapshot.take(root).diff(original) == ([], [], ['file'])
+
+    def test_previous(self, root, monkeypatch):
+        'Only reread files whose stat info changed'
+        for path in (root / 'file', root / 'subdir/subfile'):
+            os.utime(str(path), ns=(0, 0))
+        original = path_.DirSnapshot.take(root, hashlib.sha256)
+        (root / 'file').write_text('changed')
+        file_digest = Mock(wraps=path_._file_digest)
+        monkeypatch.setattr(path_, '_file_digest', file_digest)
+        snapshot = path_.DirSnapshot.take(root, hashlib.sha256, previous=original)
+        assert [call[0][0] for call in file_digest.call_args_list] == ['file']
+        assert snapshot.diff(original) == ([], [], ['file'])
+
+        # Recently modified files are not trusted
+        file_digest.reset_mock()
+        path_.DirSnapshot.take(root, hashlib.sha256, previous=snapshot)
+        assert [call[0][0] for call in file_digest.call_args_list] == ['file']
+
+        # Digests of another hash function are not used
+        file_digest.reset_mock()
+        path_.DirSnapshot.take(root, hashlib.sha512, previous=original)
+        assert file_digest.call_count == 2
+
+    def test_save_load(self, root):
+        snapshot = path_.DirSnapshot.take(root, hashlib.sha256)
+        snapshot.save(Path('snapshot'))
+        loaded = path_.DirSnapshot.load(Path('snapshot'))
+        assert loaded.paths == snapshot.paths
+        assert loaded.digests == snapshot.digests
+        assert loaded.diff(snapshot) == ([], [], [])
+        assert path_.DirSnapshot.take(root, hashlib.sha256, previous=loaded).digests == snapshot.digests
+
+class TestCopyTree:
+
+    @pytest.fixture
+    def src(self, contents):
+        Path('src/subdir').mkdir(parents=True)
+        Path('src/emptydir').mkdir()
+        Path('src/file').write_text(contents)
+        Path('src/subdir/duplicate').write_text(contents)
+        Path('src/subdir/other').write_text(contents * 2)
+        Path('src/subdir/other').chmod(0o640)
+        Path('src/link').symlink_to('subdir')
+        return Path('src')
+
+    def assert_copied(self, src, dst, mode=0o640):
+        assert path_.hash(dst).hexdigest() == path_.hash(src).hexdigest()
+        assert os.readlink(str(dst / 'link')) == 'subdir'
+        assert_file_mode(dst / 'subdir/other', mode)
+        assert not any(
+            (dst / name).stat().st_ino == (src / name).stat().st_ino
+            for name in ('file', 'subdir/duplicate', 'subdir/other')
+        )
+
+    @pytest.mark.parametrize('link', ('hardlink', 'reflink', 'copy'))
+    @pytest.mark.parametrize('executor', (False, True))
+    def test_copy(self, src, contents, link, executor):
+        dst = Path('dst')
+        if executor:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                manifest = path_.copy_tree(src, dst, link=link, executor=executor)
+        else:
+            manifest = path_.copy_tree(src, dst, link=link)
+        self.assert_copied(src, dst)
+        digest = hashlib.sha512(contents.encode()).digest()
+        assert manifest == {
+            PurePath('file'): digest,
+            PurePath('subdir/duplicate'): digest,
+            PurePath('subdir/other'): hashlib.sha512(contents.encode() * 2).digest(),
+        }
+        hardlinked = (dst / 'file').stat().st_ino == (dst / 'subdir/duplicate').stat().st_ino
+        assert hardlinked == (link == 'hardlink')
+
+    def test_reflink_first(self, src, monkeypatch):
+        'When reflinking without a store, reflink the first file of each set as well'
+        reflinked = []
+        reflink = path_._reflink
+        def reflink_(source, target):
+            reflinked.append(target)
+            reflink(source, target)
+        monkeypatch.setattr(path_, '_reflink', reflink_)
+        path_.copy_tree(src, Path('dst'), link='reflink')
+        assert len(reflinked) == 3
+
+    def test_store(self, src, contents):
+        'When copying through a store, contents are linked from it'
+        store = Path('store')
+        path_.copy_tree(src, Path('dst1'), store=store)
+        hexdigest = hashlib.sha512(contents.encode()).hexdigest()
+        store_file = store / 'sha512-64' / hexdigest[:2] / hexdigest[2:]
+        assert store_file.read_text() == contents
+        assert_file_mode(store_file, 0o444)
+        path_.copy_tree(src, Path('dst2'), store=store)
+        self.assert_copied(src, Path('dst2'), mode=0o444)
+        assert store_file.stat().st_nlink == 5
+        assert len(list(store.glob('*/*/*'))) == 2
+
+    def test_store_copy(self, src):
+        'When copying from a store, copy modes of source files'
+        path_.copy_tree(src, Path('dst'), store=Path('store'), link='reflink')
+        self.assert_copied(src, Path('dst'))
+        assert_file_mode(Path('dst/file'), Path('src/file').stat().st_mode & 0o777)
+
+    def test_manifest(self, src, contents):
+        manifest = Path('manifest.json')
+        path_.copy_tree(src, Path('dst'), hash_function=hashlib.sha256, manifest=manifest)
+        json_ = json.loads(manifest.read_text())
+        assert json_['algorithm'] == 'sha256-32'
+        assert json_['files']['subdir/duplicate'] == hashlib.sha256(contents.encode()).hexdigest()
+        assert len(json_['files']) == 3
+
+    def test_cache(self, src):
+        with path_.DigestCache(Path('cache.sqlite')) as cache:
+            path_.copy_tree(src, Path('dst1'), cache=cache)
+            path_.copy_tree(src, Path('dst2'), cache=cache)
+        self.assert_copied(src, Path('dst2'))
+
+    def test_dst_exists(self, src):
+        Path('dst').mkdir()
+        with pytest.raises(FileExistsError):
+            path_.copy_tree(src, Path('dst'))
+
+    def test_invalid_link(self, src):
+        with pytest.raises(ValueError):
+            path_.copy_tree(src, Path('dst'), link='symlink')
+
+    def test_unlistable(self, src, monkeypatch):
+        'When a directory cannot be listed, raise'
+        scandir = os.scandir
+        calls = []
+        def scandir_(path):
+            calls.append(path)
+            if len(calls) == 2:
+                raise OSError(errno.EMFILE, 'Too many open files')
+            return scandir(path)
+        monkeypatch.setattr(os, 'scandir', scandir_)
+        with pytest.raises(OSError) as ex:
+            path_.copy_tree(src, Path('dst'))
+        assert ex.value.errno == errno.EMFILE
+
+    def test_max_pending(self, src, monkeypatch):
+        'When more files are being hashed than the max, wait for the oldest'
+        monkeypatch.setattr(path_, '_max_pending_digests', 1)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            manifest = path_.copy_tree(src, Path('dst'), executor=executor)
+        assert manifest == path_.copy_tree(src, Path('dst2'))
+        self.assert_copied(src, Path('dst'))
+
 class TestTemporaryDirectory:
 
     @pytest.fixture
@@ -362,6 +960,93 @@ class TestTemporaryDirectory:
             with path_.TemporaryDirectory():
                 pass
 
+    def test_background(self, temp_dir_cwd):  # @UnusedVariable
+        'When background, remove in background thread'
+        root_tmp_dir = Path('tmp')
+        root_tmp_dir.mkdir()
+        with path_.TemporaryDirectory(dir=root_tmp_dir, background=True) as tmp_dir:
+            (tmp_dir / 'subdir').mkdir()
+            (tmp_dir / 'subdir' / 'file').touch()
+            (tmp_dir / 'subdir').chmod(0o500)
+        assert not tmp_dir.exists()
+        assert path_.wait_for_background_removals(timeout=10)
+        assert list(root_tmp_dir.iterdir()) == []
+
+    def test_background_tombstones(self, temp_dir_cwd):  # @UnusedVariable
+        'When tombstones of exited processes are left behind, remove them on next use'
+        root_tmp_dir = Path('tmp')
+        root_tmp_dir.mkdir()
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        orphan = root_tmp_dir / f'{path_._tombstone_prefix}{process.pid}-leftover'
+        orphan.mkdir()
+        (orphan / 'file').touch()
+        with path_.TemporaryDirectory(dir=root_tmp_dir, background=True):
+            pass
+        assert path_.wait_for_background_removals(timeout=10)
+        assert list(root_tmp_dir.iterdir()) == []
+
+    def test_background_own_tombstone(self, temp_dir_cwd, monkeypatch):  # @UnusedVariable
+        'When removing a tombstone of this process, do not rename it again'
+        submitted = []
+        monkeypatch.setattr(path_._background_remover, 'submit', lambda path, force: submitted.append(path))
+        tombstone = Path(f'{path_._tombstone_prefix}{os.getpid()}-dir')
+        tombstone.mkdir()
+        path_.remove_in_background(tombstone)
+        assert submitted == [tombstone]
+
+    def test_background_tombstones_alive(self, temp_dir_cwd):  # @UnusedVariable
+        'Leave tombstones of running processes alone'
+        root_tmp_dir = Path('tmp')
+        root_tmp_dir.mkdir()
+        tombstones = {
+            root_tmp_dir / f'{path_._tombstone_prefix}{os.getppid()}-parent',
+            root_tmp_dir / f'{path_._tombstone_prefix}{os.getpid()}-self',
+            root_tmp_dir / f'{path_._tombstone_prefix}unknown',
+        }
+        for tombstone in tombstones:
+            tombstone.mkdir()
+        with path_.TemporaryDirectory(dir=root_tmp_dir, background=True):
+            pass
+        assert path_.wait_for_background_removals(timeout=10)
+        assert set(root_tmp_dir.iterdir()) == tombstones
+
+    def test_background_retry(self, temp_dir_cwd, monkeypatch):  # @UnusedVariable
+        'When background removal fails, retry'
+        monkeypatch.setattr(path_._BackgroundRemover, 'retry_delay', .01)
+        remove = path_.remove
+        calls = []
+        def remove_(path, force, nfs_timeout):
+            calls.append(path)
+            if len(calls) == 1:
+                raise OSError(errno.ENOTEMPTY, 'Error msg')
+            remove(path, force=force, nfs_timeout=nfs_timeout)
+        monkeypatch.setattr(path_, 'remove', remove_)
+        with path_.TemporaryDirectory(dir=Path(), background=True):
+            pass
+        assert path_.wait_for_background_removals(timeout=10)
+        assert len(calls) == 2
+        assert not calls[0].exists()
+
+    def test_background_nfs_timeout(self, temp_dir_cwd, monkeypatch):  # @UnusedVariable
+        'When .nfs files linger, retry later instead of blocking other removals'
+        monkeypatch.setattr(path_._BackgroundRemover, 'retry_delay', .01)
+        monkeypatch.setattr(path_._BackgroundRemover, 'nfs_timeout', .05)
+        try_remove_directory = path_._try_remove_directory
+        def try_remove_directory_(directory):
+            # As if .nfs files linger until the other directory is removed
+            parent, name = os.path.split(directory)
+            if name.endswith('blocked') and any(not name_.endswith('blocked') for name_ in os.listdir(parent or os.curdir)):
+                return False
+            return try_remove_directory(directory)
+        monkeypatch.setattr(path_, '_try_remove_directory', try_remove_directory_)
+        with path_.TemporaryDirectory(dir=Path(), suffix='blocked', background=True):
+            pass
+        with path_.TemporaryDirectory(dir=Path(), background=True):
+            pass
+        assert path_.wait_for_background_removals(timeout=10)
+        assert list(Path().iterdir()) == []
+
     def test_raise(self, temp_dir_cwd, cleanup):  # @UnusedVariable
         'Test on_error=raise'
         # Let any OSError through
@@ -433,3 +1118,26 @@ def test_is_descendant(is_descendant, ancestor, descendant, expected):
     os.makedirs(str(ancestor), exist_ok=True)
     os.makedirs(str(descendant), exist_ok=True)
     assert is_descendant(descendant, ancestor) == expected
+
+@pytest.mark.parametrize(
+    'is_descendant, descendant, ancestor, expected',
+    is_descendant_parameters()
+)
+def test_ancestor_index(is_descendant, ancestor, descendant, expected):
+    'Test AncestorIndex gives the same result as is_descendant*'
+    os.makedirs(str(ancestor), exist_ok=True)
+    os.makedirs(str(descendant), exist_ok=True)
+    index = path_.AncestorIndex([Path('unrelated'), ancestor, Path('a/b/c/d')])
+    is_descendant = getattr(index, is_descendant.__name__)
+    assert is_descendant(descendant) == expected
+
+def test_ancestor_index_multiple():
+    index = path_.AncestorIndex([Path('a/b'), Path('c'), Path('a/b/d')])
+    assert index.is_descendant(Path('a/b/x'))
+    assert index.is_descendant(Path('a/b/d'))
+    assert index.is_descendant(Path('c/x/y'))
+    assert not index.is_descendant(Path('a'))
+    assert not index.is_descendant(Path('c'))
+    assert index.is_descendant_or_self(Path('c'))
+    assert not index.is_descendant_or_self(Path('a/x'))
+    assert not path_.AncestorIndex([]).is_descendant_or_self(Path('a'))
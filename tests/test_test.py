@@ -17,10 +17,21 @@
 
 from pathlib import Path
 from textwrap import dedent
+import json
+import os
 
+from openpyxl import Workbook
+import pandas as pd
 import pytest
 
 from pytil.test import assert_dir_unchanged
+from pytil.xlsx_compare import assert_xlsx_equals
+from pytil.xml_compare import assert_xml_equals
+from pytil.data_frame import assert_df_equals
+from pytil import test as test_, path as path_
+
+
+pytest_plugins = ['pytester']
 
 
 def test_assert_dir_unchanged(temp_dir_cwd):
@@ -39,3 +50,215 @@ def test_assert_dir_unchanged(temp_dir_cwd):
         Actual: {'dir/child'}
         Expected: set()'''
     )
+
+def test_assert_dir_unchanged_symlink_retargeted(temp_dir_cwd):
+    'When a symlink into an ignored dir is retargeted, it is no longer ignored'
+    dir_ = Path('dir')
+    (dir_ / 'ignored').mkdir(parents=True)
+    (dir_ / 'other').mkdir()
+    (dir_ / 'link').symlink_to('ignored')
+    with pytest.raises(AssertionError):
+        with assert_dir_unchanged(dir_, ignore=(dir_ / 'ignored',)):
+            (dir_ / 'link').unlink()
+            (dir_ / 'link').symlink_to('other')
+
+def test_assert_dir_unchanged_recursive(temp_dir_cwd):
+    dir_ = Path('dir')
+    (dir_ / 'subdir').mkdir(parents=True)
+    (dir_ / 'subdir' / 'file').write_text('contents')
+    (dir_ / 'ignored').mkdir()
+
+    # When dir unchanged or only ignored paths change, nothing happens
+    with assert_dir_unchanged(dir_, ignore=(dir_ / 'ignored',), recursive=True):
+        (dir_ / 'ignored' / 'file').touch()
+
+    # When a descendant changes, raise
+    with pytest.raises(AssertionError) as ex:
+        with assert_dir_unchanged(dir_, recursive=True):
+            (dir_ / 'subdir' / 'file').write_text('changed')
+            (dir_ / 'subdir' / 'new').mkdir()
+            (dir_ / 'ignored' / 'file').unlink()
+    assert ex.value.args[0] == dedent('''
+        Added: ['subdir/new']
+        Removed: ['ignored/file']
+        Modified: ['subdir/file']'''
+    )
+
+def test_assert_dir_unchanged_contents(temp_dir_cwd):
+    'When comparing contents, ignore stat changes'
+    dir_ = Path('dir')
+    dir_.mkdir()
+    file = dir_ / 'file'
+    file.write_text('contents')
+    with assert_dir_unchanged(dir_, recursive=True, contents=True):
+        file.write_text('contents')
+        os.utime(str(file), ns=(0, 0))
+    with pytest.raises(AssertionError):
+        with assert_dir_unchanged(dir_, recursive=True, contents=True):
+            file.write_text('changed')
+            os.utime(str(file), ns=(0, 0))
+
+def test_assert_dir_unchanged_ignore_pruned(temp_dir_cwd, monkeypatch):
+    'Do not walk into ignored directories'
+    dir_ = Path('dir')
+    (dir_ / 'ignored').mkdir(parents=True)
+    (dir_ / 'ignored' / 'ignored_file').write_text('contents')
+    (dir_ / 'file').write_text('contents')
+    hashed = []
+    file_digest = path_._file_digest
+    def file_digest_(name, *args, **kwargs):
+        hashed.append(name)
+        return file_digest(name, *args, **kwargs)
+    monkeypatch.setattr(path_, '_file_digest', file_digest_)
+    with assert_dir_unchanged(dir_, ignore=(dir_ / 'ignored',), recursive=True, contents=True):
+        (dir_ / 'ignored' / 'ignored_file').write_text('changed')
+    assert set(hashed) == {'file'}
+
+def test_assert_dir_unchanged_contents_not_recursive(temp_dir_cwd):
+    with pytest.raises(ValueError):
+        with assert_dir_unchanged(Path(), contents=True):
+            pass
+
+class TestTempDirCwdTmpfs:
+
+    @pytest.fixture
+    def removals(self, monkeypatch):
+        '''
+        Expected calls of remove_in_background, asserted on after teardown of
+        fixtures requested after this one.
+        '''
+        actual = []
+        remove_in_background = path_.remove_in_background
+        def remove(path, force=False):
+            actual.append((path, force))
+            remove_in_background(path, force=force)
+        monkeypatch.setattr(path_, 'remove_in_background', remove)
+        expected = []
+        yield expected
+        assert actual == expected
+
+    @pytest.fixture
+    def no_tmpfs(self, monkeypatch):
+        monkeypatch.setattr(test_, '_tmpfs', '/nonexistent')
+
+    def test_cwd(self, temp_dir_cwd_tmpfs):
+        assert Path.cwd() == temp_dir_cwd_tmpfs
+        assert not list(temp_dir_cwd_tmpfs.iterdir())
+        if os.access('/dev/shm', os.W_OK):
+            assert temp_dir_cwd_tmpfs.parent == Path('/dev/shm')
+
+    def test_no_tmpfs(self, no_tmpfs, temp_dir_cwd_tmpfs, tmp_path_factory):
+        assert temp_dir_cwd_tmpfs.parent == tmp_path_factory.getbasetemp()
+
+    def test_removed(self, removals, temp_dir_cwd_tmpfs):
+        'On teardown, remove in background, forced'
+        Path('dir').mkdir()
+        Path('dir/file').touch()
+        Path('dir').chmod(0o500)
+        removals.append((temp_dir_cwd_tmpfs, True))
+
+    def test_tombstone(self, temp_dir_cwd_tmpfs):
+        'Name the directory as a tombstone of the process, to be swept if it is killed'
+        assert temp_dir_cwd_tmpfs.name.startswith(f'{path_._tombstone_prefix}{os.getpid()}-')
+
+class TestGoldenCache:
+
+    @pytest.fixture
+    def xml_file(self, temp_dir_cwd):
+        path = Path('file.xml')
+        path.write_text('<root><child/></root>')
+        return path
+
+    def test_xml(self, xml_file):
+        cache = test_.GoldenCache()
+        root = cache.xml(xml_file)
+        assert root.tag == 'root'
+        assert cache.xml(xml_file) is root
+        assert_xml_equals('<root>  <child/></root>', root)
+
+    def test_xml_message(self, xml_file):
+        'When a cached XML differs, report its file'
+        cache = test_.GoldenCache()
+        with pytest.raises(AssertionError) as ex:
+            assert_xml_equals('<root/>', cache.xml(xml_file))
+        assert 'Expected XML: file.xml\n' in ex.value.args[0]
+
+    def test_mtime(self, xml_file):
+        'When file changes, parse it again'
+        cache = test_.GoldenCache()
+        root = cache.xml(xml_file)
+        xml_file.write_text('<root2/>')
+        os.utime(str(xml_file), ns=(0, 0))
+        assert cache.xml(xml_file).tag == 'root2'
+
+    def test_lru(self, temp_dir_cwd):
+        cache = test_.GoldenCache(maxsize=2)
+        paths = [Path(f'file{i}.xml') for i in range(3)]
+        for path in paths:
+            path.write_text('<root/>')
+        roots = [cache.xml(path) for path in paths[:2]]
+        cache.xml(paths[0])
+        cache.xml(paths[2])  # evicts paths[1]
+        assert cache.xml(paths[0]) is roots[0]
+        assert cache.xml(paths[1]) is not roots[1]
+
+    def test_workbook(self, temp_dir_cwd):
+        workbook = Workbook()
+        workbook.active['A1'] = 1
+        workbook.save('file.xlsx')
+        cache = test_.GoldenCache()
+        expected = cache.workbook(Path('file.xlsx'))
+        assert cache.workbook(Path('file.xlsx')) is expected
+        assert_xlsx_equals(Path('file.xlsx'), expected)
+
+    def test_data_frame(self, temp_dir_cwd):
+        pd.DataFrame({'a': [1, 2]}).to_pickle('file.pickle')
+        cache = test_.GoldenCache()
+        df = cache.data_frame(Path('file.pickle'), pd.read_pickle)
+        assert cache.data_frame(Path('file.pickle'), pd.read_pickle) is df
+        assert_df_equals(df, pd.DataFrame({'a': [1, 2]}))
+
+    def test_fixture(self, golden_cache):
+        assert isinstance(golden_cache, test_.GoldenCache)
+
+class TestHelperTimings:
+
+    @pytest.fixture
+    def test_file(self, pytester):
+        pytester.makepyfile(test_helpers='''
+            from pathlib import Path
+            from pytil.xml_compare import assert_xml_equals
+            from pytil import path
+
+            def test_xml():
+                assert_xml_equals('<a/>', '<a/>')
+                assert_xml_equals('<a/>', '<a/>')
+
+            def test_hash():
+                Path('file').write_text('contents')
+                path.hash(Path('file'))
+        ''')
+
+    def test_summary(self, pytester, test_file):
+        result = pytester.runpytest('-p', 'pytil.test', '--pytil-timings', '--pytil-timings-top', '1')
+        result.assert_outcomes(passed=2)
+        # Helpers are sorted by time, which is about equal for both
+        result.stdout.fnmatch_lines(['*pytil helper timings*', '*s       2 calls  pytil.xml_compare.assert_xml_equals'])
+        result.stdout.fnmatch_lines(['*pytil helper timings*', '*s       1 calls  pytil.path.hash'])
+        result.stdout.fnmatch_lines([
+            '*pytil helper timings*',
+            'Slowest 1 (test, helper) pairs:',
+            '*s       * calls  pytil.*  test_helpers.py::test_*',
+        ])
+
+    def test_json(self, pytester, test_file):
+        result = pytester.runpytest('-p', 'pytil.test', '--pytil-timings', '--pytil-timings-json', 'timings.json')
+        result.assert_outcomes(passed=2)
+        timings = json.loads((pytester.path / 'timings.json').read_text())
+        assert timings['helpers']['pytil.xml_compare.assert_xml_equals']['calls'] == 2
+        assert timings['tests']['test_helpers.py::test_hash']['pytil.path.hash']['calls'] == 1
+
+    def test_disabled(self, pytester, test_file):
+        result = pytester.runpytest('-p', 'pytil.test')
+        result.assert_outcomes(passed=2)
+        assert 'pytil helper timings' not in result.stdout.str()
@@ -0,0 +1,126 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of pytil.
+#
+# pytil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pytil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pytil.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.formatting.rule import CellIsRule
+from openpyxl.styles import Border, Side
+import pytest
+
+from pytil.xlsx_compare import assert_xlsx_equals
+
+
+def create_workbook(path, value=1, border_style='thin', cf_value='1'):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'first'
+    for row in range(1, 4):
+        for column in range(1, 4):
+            sheet.cell(row, column, row * column)
+    sheet['B2'] = value
+    sheet['C3'].border = Border(left=Side(style=border_style))
+    sheet['A3'].border = Border(left=Side(style=border_style))
+    sheet.conditional_formatting.add('A1:C3', CellIsRule(operator='equal', formula=[cf_value]))
+    workbook.create_sheet('second')['A1'] = 'text'
+    workbook.save(str(path))
+    return path
+
+@pytest.fixture
+def expected(temp_dir_cwd):
+    return create_workbook(Path('expected.xlsx'))
+
+def differences(actual, expected, streaming, max_differences=None):
+    with pytest.raises(AssertionError) as ex:
+        assert_xlsx_equals(actual, expected, streaming=streaming, max_differences=max_differences)
+    return ex.value.args[0]
+
+@pytest.mark.parametrize('streaming', (False, True))
+def test_equal(expected, streaming):
+    actual = create_workbook(Path('actual.xlsx'))
+    assert_xlsx_equals(actual, expected, streaming=streaming)
+
+@pytest.mark.parametrize('kwargs', (
+    {'value': 2},
+    {'border_style': 'thick'},
+    {'cf_value': '2'},
+    {'value': 'text', 'border_style': 'dashed', 'cf_value': '3'},
+))
+def test_streaming_same_differences(expected, kwargs):
+    'When streaming, report the same differences'
+    actual = create_workbook(Path('actual.xlsx'), **kwargs)
+    assert differences(actual, expected, streaming=True) == differences(actual, expected, streaming=False)
+
+def test_streaming_missing_cells(expected):
+    'When streaming, compare cells missing in the other sheet as blank'
+    workbook = load_workbook(str(expected))
+    workbook['second']['B5'].number_format = '0.00'  # not compared
+    workbook.save('actual.xlsx')
+    assert_xlsx_equals(Path('actual.xlsx'), expected, streaming=True)
+    workbook['second']['B5'] = 1
+    workbook.save('actual.xlsx')
+    assert differences(Path('actual.xlsx'), expected, streaming=True) == 'second: Cell 25: value:\n1\n!=\nNone'
+
+def test_streaming_workbook(expected):
+    with pytest.raises(ValueError):
+        assert_xlsx_equals(load_workbook(str(expected)), expected, streaming=True)
+
+@pytest.mark.parametrize('max_differences', (0, -1))
+def test_max_differences_invalid(expected, max_differences):
+    with pytest.raises(ValueError):
+        assert_xlsx_equals(expected, expected, max_differences=max_differences)
+
+@pytest.fixture
+def sheets(temp_dir_cwd):
+    'Actual and expected workbooks with multiple sheets, which differ in 5 cells per sheet'
+    files = []
+    for offset in (0, 1):
+        workbook = Workbook()
+        for i in range(4):
+            sheet = workbook.create_sheet(f'sheet{i}')
+            for row in range(1, 4):
+                sheet.append([row, row * 2 if row == 2 else row * 2 + offset, row * 3 + offset])
+        path = Path(f'file{offset}.xlsx')
+        workbook.save(str(path))
+        files.append(path)
+    return files
+
+@pytest.mark.parametrize('max_differences', (None, 1, 5))
+def test_max_differences(sheets, max_differences):
+    actual, expected = sheets
+    all_differences = differences(actual, expected, streaming=False).split('\n\n')
+    for streaming in (False, True):
+        differences_ = differences(actual, expected, streaming, max_differences).split('\n\n')
+        assert differences_ == all_differences[:max_differences]
+
+@pytest.mark.parametrize('max_differences', (None, 1, 5))
+def test_executor(sheets, max_differences):
+    'When comparing sheets concurrently, report the same differences in sheet order'
+    actual, expected = sheets
+    expected_differences = differences(actual, expected, streaming=True)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(AssertionError) as ex:
+            assert_xlsx_equals(actual, expected, executor=executor, max_differences=max_differences)
+    assert ex.value.args[0].split('\n\n') == expected_differences.split('\n\n')[:max_differences]
+
+def test_executor_sheetnames(sheets):
+    actual, _ = sheets
+    create_workbook(Path('other.xlsx'))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(AssertionError):
+            assert_xlsx_equals(actual, Path('other.xlsx'), executor=executor)